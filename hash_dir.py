@@ -23,51 +23,460 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import concurrent.futures
 import glob
-import hashlib
+import itertools
+import json
 import os
 import shutil
+import stat
 import subprocess
 import sys
 
+import hashing
+
+# Upper limit on the number of files handed to a worker process at once, the number used when the total isn't known in
+# advance, and the number of chunks queued up per worker.
+MAX_CHUNK_SIZE = 64
+STREAM_CHUNK_SIZE = 16
+CHUNKS_IN_FLIGHT_PER_JOB = 2
+
+# Name of the index file kept at the top of a content-addressed store, and the number of hex digits in each level of its directories.
+INDEX_FILE_NAME = ".hash_dir_index"
+SHARD_WIDTH = 2
+
+# Number of bytes read from each end of a file when weeding out duplicate candidates before hashing them fully.
+EDGE_SIZE = 4096
+
 def normjoin(*args):
     return os.path.normpath(os.path.join(*args))
     
-def hash_file(file_to_hash):
-    hash_algorithm = hashlib.sha256()
-    file = open(file_to_hash)
-    while True:
-        contents = file.read(65536)
-        if not contents:
-            break
-        hash_algorithm.update(contents)
-    hash_str = hash_algorithm.hexdigest()
-    return hash_str
-
-def hash_dir(dir, rename_file, git_move_file, extension):
-    files_to_hash = glob.glob(normjoin(dir, '*'))
-    for file_to_hash in files_to_hash:
+def hash_file(file_to_hash, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM, buffer_size=hashing.DEFAULT_BUFFER_SIZE):
+    return hashing.hash_file(file_to_hash, hash_algorithm, buffer_size)
+
+def hash_file_or_none(file_to_hash, hash_algorithm, buffer_size):
+    """Worker process entry point. Returns the file's hash, or None if it couldn't be hashed."""
+    try:
+        return hash_file(file_to_hash, hash_algorithm, buffer_size)
+    except:
+        return None
+
+def hash_chunk(files_to_hash, hash_algorithm, buffer_size):
+    """Worker process entry point. Hashes a list of files, returning a list of hashes (or None for files that couldn't be hashed)."""
+    return [ hash_file_or_none(file_to_hash, hash_algorithm, buffer_size) for file_to_hash in files_to_hash ]
+
+def hash_files(files_to_hash, hash_algorithm, buffer_size, jobs):
+    """Hashes the files, using a pool of worker processes if more than one job is requested. Yields (file, hash) pairs in the
+    same order as the input, with a hash of None for any file that couldn't be hashed. The input can be any iterable; it is
+    consumed as hashing progresses, so only a few chunks of files are ever held in memory."""
+    if jobs <= 1:
+        for file_to_hash in files_to_hash:
+            yield file_to_hash, hash_file_or_none(file_to_hash, hash_algorithm, buffer_size)
+        return
+
+    # Hand the files out in chunks so that directories of small files don't spend all their time on interprocess overhead.
+    if isinstance(files_to_hash, list):
+        chunk_size = max(1, min(MAX_CHUNK_SIZE, len(files_to_hash) // (jobs * 4)))
+    else:
+        chunk_size = STREAM_CHUNK_SIZE
+    files_iter = iter(files_to_hash)
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            while len(pending) < jobs * CHUNKS_IN_FLIGHT_PER_JOB:
+                chunk = list(itertools.islice(files_iter, chunk_size))
+                if len(chunk) == 0:
+                    break
+                pending.append((chunk, executor.submit(hash_chunk, chunk, hash_algorithm, buffer_size)))
+            if len(pending) == 0:
+                break
+            chunk, future = pending.popleft()
+            for file_to_hash, hash_str in zip(chunk, future.result()):
+                yield file_to_hash, hash_str
+
+def list_files(dir, recurse):
+    """Yields the files to hash, in sorted order. Without recursion this is everything in the directory itself."""
+    if not recurse:
+        for file_name in sorted(glob.glob(normjoin(dir, '*'))):
+            yield file_name
+        return
+    for root, dir_names, file_names in os.walk(dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            yield os.path.join(root, file_name)
+
+def manifest_line(hash_str, file_name):
+    """Formats a checksum manifest line the same way sha256sum does, including its escaping of names with backslashes or newlines."""
+    if '\\' in file_name or '\n' in file_name:
+        return "\\" + hash_str + "  " + file_name.replace("\\", "\\\\").replace("\n", "\\n") + "\n"
+    return hash_str + "  " + file_name + "\n"
+
+def parse_manifest_line(line):
+    """Parses a line written by manifest_line (or sha256sum), returning a (hash, file name) tuple, or None if the line isn't valid."""
+    line = line.rstrip('\n')
+    escaped = line.startswith("\\")
+    if escaped:
+        line = line[1:]
+    hash_str, separator, file_name = line.partition(' ')
+    if len(separator) == 0 or len(file_name) < 2 or file_name[0] not in ' *':
+        return None
+    file_name = file_name[1:]
+    if escaped:
+        unescaped = []
+        chars = iter(file_name)
+        for c in chars:
+            if c == '\\':
+                c = next(chars, '')
+                unescaped.append('\n' if c == 'n' else c)
+            else:
+                unescaped.append(c)
+        file_name = "".join(unescaped)
+    return hash_str, file_name
+
+def manifest_hash_length(manifest_file_name):
+    """Returns the number of hex digits in the first hash in the manifest, or None if it has no valid lines."""
+    with open(manifest_file_name, 'r') as manifest_file:
+        for line in manifest_file:
+            entry = parse_manifest_line(line)
+            if entry is not None:
+                return len(entry[0])
+    return None
+
+def check_manifest(manifest_file_name, dir, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM, buffer_size=hashing.DEFAULT_BUFFER_SIZE, jobs=1):
+    """Verifies the files listed in a checksum manifest, with names relative to the given directory. Mismatched, missing, and
+    unreadable files are printed as they are found, followed by a summary. Returns True if every file matched."""
+    expected = collections.deque()
+    counts = collections.Counter()
+
+    # The sha256sum format doesn't say which algorithm was used, but the length of the hashes rules most of them out, so
+    # a manifest written with a different --hash-algo isn't reported as every file having changed.
+    hash_length = manifest_hash_length(manifest_file_name)
+    if hash_length is not None and hash_length != len(hashing.new_hash(hash_algorithm).hexdigest()):
+        matching_algorithms = [ algorithm for algorithm in hashing.available_algorithms() if len(hashing.new_hash(algorithm).hexdigest()) == hash_length ]
+        print("Algorithm mismatch: " + manifest_file_name + " has " + str(hash_length) + " digit hashes, which " + hash_algorithm + " doesn't produce" +
+            (" (try --hash-algo " + " or ".join(matching_algorithms) + ")." if len(matching_algorithms) > 0 else "."))
+        return False
+
+    def files_to_check():
+        """Reads the manifest as the files are checked, remembering each expected hash until its result comes back."""
+        with open(manifest_file_name, 'r') as manifest_file:
+            for line in manifest_file:
+                entry = parse_manifest_line(line)
+                if entry is None:
+                    if len(line.strip()) > 0:
+                        counts['malformed'] += 1
+                    continue
+                expected.append(entry)
+                yield os.path.join(dir, entry[1])
+
+    for file_to_check, hash_str in hash_files(files_to_check(), hash_algorithm, buffer_size, jobs):
+        expected_hash_str, file_name = expected.popleft()
+        counts['checked'] += 1
+        if hash_str is None:
+            if os.path.exists(file_to_check):
+                print(file_name + ": FAILED open or read")
+                counts['unreadable'] += 1
+            else:
+                print(file_name + ": MISSING")
+                counts['missing'] += 1
+        elif hash_str != expected_hash_str.lower():
+            print(file_name + ": FAILED")
+            counts['mismatched'] += 1
+
+    print(str(counts['checked']) + " files checked, " + str(counts['mismatched']) + " mismatched, " + str(counts['missing']) + " missing, " +
+        str(counts['unreadable']) + " unreadable, " + str(counts['malformed']) + " malformed lines.")
+
+    # Some algorithms' hashes are the same length (sha256 and blake2s, for instance), so nothing matching at all is the only clue.
+    if counts['checked'] > 0 and counts['mismatched'] == counts['checked']:
+        other_algorithms = [ algorithm for algorithm in hashing.available_algorithms() if algorithm != hash_algorithm and len(hashing.new_hash(algorithm).hexdigest()) == hash_length ]
+        if len(other_algorithms) > 0:
+            print("No files matched, the manifest may have been written with --hash-algo " + " or ".join(other_algorithms) + ".")
+    return counts['mismatched'] + counts['missing'] + counts['unreadable'] + counts['malformed'] == 0
+
+def object_path(store_dir, hash_str, extension, shard_depth):
+    """Returns where a file with the given hash belongs. With a shard depth of N, the file is placed N directories deep, each
+    named after the next two hex digits of the hash (e.g. ab/cd/abcdef... for a depth of two), so that no directory gets too large."""
+    dirs = [ hash_str[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(0, shard_depth) ]
+    new_file = os.path.join(store_dir, *(dirs + [hash_str]))
+    if extension is not None and len(extension) > 0:
+        new_file = new_file + "." + extension
+    return new_file
+
+def index_algorithm(store_dir):
+    """Returns the hash algorithm the store's objects are named with, as recorded in its index, or None if that isn't known
+    (there is no index yet, or it predates the algorithm being recorded)."""
+    try:
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), 'r') as index_file:
+            line = index_file.readline()
+    except FileNotFoundError:
+        return None
+    if len(line.strip()) == 0:
+        return None
+    return json.loads(line).get('algorithm')
+
+def append_index(store_dir, entries, hash_algorithm):
+    """Adds the (original file name, hash, stored file name) entries to the store's index."""
+    with open(os.path.join(store_dir, INDEX_FILE_NAME), 'a') as index_file:
+        for name, hash_str, stored_file in entries:
+            index_file.write(json.dumps({ 'name': name, 'hash': hash_str, 'algorithm': hash_algorithm, 'path': os.path.relpath(stored_file, store_dir) }) + "\n")
+
+def git_move_files(dir, moves):
+    """Does the equivalent of 'git mv' for each (old, new) pair of files in the directory, but renames the files directly and
+    then updates the index with a single 'git update-index' call, rather than having git rewrite the index once per file.
+    As with 'git mv', files that aren't tracked, or whose new name already exists, are left alone."""
+
+    # Look up the index entries (mode and object ID) for the files in this directory. Paths in the index are relative to the
+    # top of the work tree.
+    top_dir = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=dir).decode().strip()
+    index_entries = {}
+    ls_files_output = subprocess.check_output(["git", "ls-files", "--stage", "-z", "--full-name", "--", "."], cwd=dir)
+    for record in ls_files_output.split(b'\0'):
+        if len(record) == 0:
+            continue
+        info, path = record.split(b'\t', 1)
+        mode, object_id, stage = info.split(b' ')
+        if stage == b'0':
+            index_entries[path.decode()] = (mode, object_id)
+
+    # Rename the files, building up the index changes as we go. Each rename is an entry removal (a zero mode) and an addition.
+    renamed_files = []
+    index_info = []
+    for old_file, new_file in moves:
+        old_path = os.path.relpath(os.path.realpath(old_file), top_dir).replace(os.sep, '/')
+        new_path = os.path.relpath(os.path.realpath(new_file), top_dir).replace(os.sep, '/')
+        if old_path not in index_entries:
+            print(old_file + " is not under version control")
+            continue
+        if os.path.exists(new_file):
+            print("Exception with " + old_file + ", " + new_file + " already exists")
+            continue
         try:
-            hash_str = hash_file(file_to_hash)
-            print(file_to_hash + " hashes to " + hash_str)
+            new_dir = os.path.dirname(new_file)
+            if new_dir and not os.path.isdir(new_dir):
+                os.makedirs(new_dir)
+            os.rename(old_file, new_file)
+        except:
+            print("Exception with " + old_file)
+            continue
+        renamed_files.append((old_file, new_file))
+        mode, object_id = index_entries[old_path]
+        index_info.append(b"0 " + b"0" * len(object_id) + b"\t" + old_path.encode() + b"\0")
+        index_info.append(mode + b" " + object_id + b"\t" + new_path.encode() + b"\0")
 
-            path, _ = os.path.split(file_to_hash)
-            new_file = os.path.join(path, hash_str)
-            if extension is not None and len(extension) > 0:
-                new_file = new_file + "." + extension
+    # Apply all of the index changes at once. If that fails then put the files back so the work tree still matches the index.
+    if len(index_info) > 0:
+        result = subprocess.run(["git", "update-index", "-z", "--index-info"], input=b"".join(index_info), cwd=dir)
+        if result.returncode != 0:
+            for old_file, new_file in reversed(renamed_files):
+                os.rename(new_file, old_file)
+            raise subprocess.CalledProcessError(result.returncode, result.args)
+    return renamed_files
+
+def hash_dir(dir, rename_file, git_move_file, extension, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM, buffer_size=hashing.DEFAULT_BUFFER_SIZE, jobs=1, store_dir=None, shard_depth=0, recurse=False, manifest_file_name=None):
+    files_to_hash = list_files(dir, recurse)
+
+    # Renaming into a separate or sharded store makes the store a content-addressed one, with an index of where everything came from.
+    use_store = store_dir is not None or shard_depth > 0
+    if use_store and store_dir is None:
+        store_dir = dir
+
+    # Objects are named after their hashes, so mixing algorithms in one store would break the lookup of what's already stored.
+    if use_store and (rename_file or git_move_file):
+        store_algorithm = index_algorithm(store_dir)
+        if store_algorithm is not None and store_algorithm != hash_algorithm:
+            print("The store in " + store_dir + " uses " + store_algorithm + ", not " + hash_algorithm + ".")
+            return False
+
+    # A manifest is written in the sha256sum format, with names relative to the directory, and replaces the usual output.
+    # It's written as the files are hashed, so nothing needs to be kept in memory unless the files are being renamed.
+    manifest_file = None
+    if manifest_file_name == "-":
+        manifest_file = sys.stdout
+    elif manifest_file_name is not None:
+        manifest_file = open(manifest_file_name, 'w')
+        manifest_real_path = os.path.realpath(manifest_file_name)
+        files_to_hash = ( file_name for file_name in files_to_hash if os.path.realpath(file_name) != manifest_real_path )
+
+    # Hash everything first. Files are only renamed once hashing is complete so that the workers never see a file move.
+    hashed_files = []
+    try:
+        for file_to_hash, hash_str in hash_files(files_to_hash, hash_algorithm, buffer_size, jobs):
+            if hash_str is None:
+                print("Exception with " + file_to_hash, file=sys.stderr if manifest_file is not None else sys.stdout)
+                continue
+            if manifest_file is not None:
+                manifest_file.write(manifest_line(hash_str, os.path.relpath(file_to_hash, dir)))
+            else:
+                print(file_to_hash + " hashes to " + hash_str)
+            if rename_file or git_move_file:
+                hashed_files.append((file_to_hash, hash_str))
+    finally:
+        if manifest_file is not None and manifest_file is not sys.stdout:
+            manifest_file.close()
+
+    git_moves = []
+    index_entries = []
+    queued_copies = {} # Other copies of the objects that will be in the store once the git moves are done, by object
+    for file_to_hash, hash_str in hashed_files:
+        try:
+            if use_store:
+                new_file = object_path(store_dir, hash_str, extension, shard_depth)
+            else:
+                path, _ = os.path.split(file_to_hash)
+                new_file = object_path(path, hash_str, extension, 0)
+            if use_store and (rename_file or git_move_file):
+
+                # The object's location follows from its hash, so checking whether it's already stored is a single lookup.
+                if new_file in queued_copies:
+                    print(file_to_hash + " is already stored as " + new_file)
+                    queued_copies[new_file].append((file_to_hash, hash_str, new_file))
+                    continue
+                if os.path.exists(new_file):
+                    print(file_to_hash + " is already stored as " + new_file)
+                    index_entries.append((file_to_hash, hash_str, new_file))
+                    continue
             if rename_file:
+                new_dir = os.path.dirname(new_file)
+                if new_dir and not os.path.isdir(new_dir):
+                    os.makedirs(new_dir)
                 shutil.move(file_to_hash, new_file)
+                index_entries.append((file_to_hash, hash_str, new_file))
             elif git_move_file:
-                subprocess.call(["git", "mv", file_to_hash, new_file])
+                git_moves.append((file_to_hash, new_file))
+                queued_copies[new_file] = []
         except:
             print("Exception with " + file_to_hash)
 
+    if len(git_moves) > 0:
+        try:
+            hashes = dict(hashed_files)
+            for file_to_hash, new_file in git_move_files(dir, git_moves):
+                index_entries.append((file_to_hash, hashes[file_to_hash], new_file))
+                index_entries.extend(queued_copies[new_file])
+        except:
+            print("Exception with git index update in " + dir)
+
+    if use_store and len(index_entries) > 0:
+        append_index(store_dir, index_entries, hash_algorithm)
+    return True
+
+def edge_hash_file(file_to_hash, file_size, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM):
+    """Hashes the first and last few KB of the file. Files that differ here can't be duplicates, so there's no need to read the rest."""
+    hash_algorithm = hashing.new_hash(hash_algorithm)
+    with open(file_to_hash, 'rb') as f:
+        hash_algorithm.update(f.read(EDGE_SIZE))
+        if file_size > 2 * EDGE_SIZE:
+            f.seek(file_size - EDGE_SIZE)
+        hash_algorithm.update(f.read(EDGE_SIZE))
+    return hash_algorithm.hexdigest()
+
+def group_files(files, key_func):
+    """Groups the files by the given key, returning only the groups with more than one file in them."""
+    groups = {}
+    for file in files:
+        try:
+            key = key_func(file)
+        except:
+            print("Exception with " + file)
+            continue
+        groups.setdefault(key, []).append(file)
+    return [ sorted(group) for group in groups.values() if len(group) > 1 ]
+
+def find_duplicates(dir, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM, buffer_size=hashing.DEFAULT_BUFFER_SIZE, jobs=1):
+    """Recursively searches the directory for files with identical contents. Files are grouped by size, then by a hash of their
+    first and last few KB, and only the files that are still in a group are hashed fully. Returns a list of (size, files) tuples."""
+
+    # Group by size. Empty files are skipped, as are extra links to a file we've already seen, since they're already deduplicated.
+    files_by_size = {}
+    seen_inodes = set()
+    for root, _, file_names in os.walk(dir):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            try:
+                file_stat = os.lstat(file_path)
+            except OSError:
+                print("Exception with " + file_path)
+                continue
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+                continue
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in seen_inodes:
+                continue
+            seen_inodes.add(inode)
+            files_by_size.setdefault(file_stat.st_size, []).append(file_path)
+
+    # Group by the ends of the files. Small files are read entirely by this, so there's no need to hash them again.
+    duplicates = []
+    candidate_groups = []
+    for file_size in sorted(files_by_size.keys()):
+        same_size_files = files_by_size[file_size]
+        if len(same_size_files) < 2:
+            continue
+        for edge_group in group_files(same_size_files, lambda file: edge_hash_file(file, file_size, hash_algorithm)):
+            if file_size <= 2 * EDGE_SIZE:
+                duplicates.append((file_size, edge_group))
+            else:
+                candidate_groups.append((file_size, edge_group))
+
+    # Group whatever's left by the full hash. The candidates are hashed in a single batch so that they can all share the worker pool.
+    full_hashes = dict(hash_files([ file for _, group in candidate_groups for file in group ], hash_algorithm, buffer_size, jobs))
+    for file_size, edge_group in candidate_groups:
+        for full_group in group_files([ file for file in edge_group if full_hashes[file] is not None ], lambda file: full_hashes[file]):
+            duplicates.append((file_size, full_group))
+    duplicates.sort()
+    return duplicates
+
+def hardlink_file(source_file, link_file):
+    """Replaces link_file with a hard link to source_file. The link is made under a temporary name first so that link_file is never missing."""
+    temp_file = link_file + ".hash_dir.tmp"
+    os.link(source_file, temp_file)
+    try:
+        os.replace(temp_file, link_file)
+    except:
+        os.remove(temp_file)
+        raise
+
+def report_duplicates(dir, hardlink, delete, hash_algorithm=hashing.DEFAULT_HASH_ALGORITHM, buffer_size=hashing.DEFAULT_BUFFER_SIZE, jobs=1):
+    """Prints each set of duplicate files in the directory tree, keeping the first file of each set and optionally hard
+    linking or deleting the others."""
+    num_extras = 0
+    bytes_redundant = 0
+    duplicates = find_duplicates(dir, hash_algorithm, buffer_size, jobs)
+    for file_size, files in duplicates:
+        print("Duplicates (" + str(file_size) + " bytes each):")
+        keep_file = files[0]
+        print("    " + keep_file)
+        for extra_file in files[1:]:
+            print("    " + extra_file)
+            try:
+                if hardlink:
+                    hardlink_file(keep_file, extra_file)
+                elif delete:
+                    os.remove(extra_file)
+            except:
+                print("Exception with " + extra_file)
+        num_extras = num_extras + len(files) - 1
+        bytes_redundant = bytes_redundant + file_size * (len(files) - 1)
+    print(str(len(duplicates)) + " duplicate sets, " + str(num_extras) + " redundant files, " + str(bytes_redundant) + " redundant bytes.")
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", type=str, action="store", default=".", help="Directory to hash", required=True)
     parser.add_argument("--rename", action="store_true", default=False, help="Set to TRUE to rename the files", required=False)
     parser.add_argument("--git-move", action="store_true", default=False, help="Set to TRUE to git mv the files", required=False)
     parser.add_argument("--extension", type=str, action="store", default=".", help="Extension to append", required=False)
+    parser.add_argument("--hash-algo", type=str, action="store", default=hashing.DEFAULT_HASH_ALGORITHM, choices=hashing.available_algorithms(), help="Hash algorithm to use", required=False)
+    parser.add_argument("--buffer-size", type=int, action="store", default=hashing.DEFAULT_BUFFER_SIZE // 1024, help="Read buffer size, in KB", required=False)
+    parser.add_argument("--store-dir", type=str, action="store", default=None, help="Directory to rename files into, as a content-addressed store with an index of the original names", required=False)
+    parser.add_argument("--shard-depth", type=int, action="store", default=0, help="Number of levels of two hex digit subdirectories to store renamed files under (e.g. 2 for ab/cd/abcd...)", required=False)
+    parser.add_argument("--find-duplicates", action="store_true", default=False, help="Recursively search for duplicate files instead of hashing each file", required=False)
+    parser.add_argument("--hardlink", action="store_true", default=False, help="With --find-duplicates, replace duplicate files with hard links to the first file of each set", required=False)
+    parser.add_argument("--delete-duplicates", action="store_true", default=False, help="With --find-duplicates, delete all but the first file of each set", required=False)
+    parser.add_argument("--recurse", action="store_true", default=False, help="Hash files in subdirectories too", required=False)
+    parser.add_argument("--manifest", type=str, action="store", default=None, help="Write a sha256sum-style checksum manifest to this file ('-' for stdout) instead of the usual output", required=False)
+    parser.add_argument("--check", type=str, action="store", default=None, help="Verify the files listed in this checksum manifest, relative to --dir", required=False)
+    parser.add_argument("--jobs", type=int, action="store", default=1, help="Number of files to hash in parallel, each in its own process", required=False)
 
     try:
         args = parser.parse_args()
@@ -75,7 +484,18 @@ def main():
         parser.error(e)
         sys.exit(1)
 
-    hash_dir(args.dir, args.rename, args.git_move, args.extension)
+    if args.hardlink and args.delete_duplicates:
+        print("--hardlink and --delete-duplicates cannot be used together.")
+        sys.exit(1)
+
+    if args.check is not None:
+        if not check_manifest(args.check, args.dir, args.hash_algo, args.buffer_size * 1024, args.jobs):
+            sys.exit(1)
+    elif args.find_duplicates:
+        report_duplicates(args.dir, args.hardlink, args.delete_duplicates, args.hash_algo, args.buffer_size * 1024, args.jobs)
+    else:
+        if not hash_dir(args.dir, args.rename, args.git_move, args.extension, args.hash_algo, args.buffer_size * 1024, args.jobs, args.store_dir, args.shard_depth, args.recurse, args.manifest):
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
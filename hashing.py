@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import hashlib
+import sys
+import threading
+
+# xxhash is optional. It's much faster than the cryptographic hashes, but isn't part of the standard library.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_ALGORITHM_BLAKE2B = "blake2b"
+HASH_ALGORITHM_BLAKE2S = "blake2s"
+HASH_ALGORITHM_SHA1 = "sha1"
+HASH_ALGORITHM_SHA256 = "sha256"
+HASH_ALGORITHM_XXH64 = "xxh64"
+HASH_ALGORITHM_XXH3_128 = "xxh3_128"
+
+DEFAULT_HASH_ALGORITHM = HASH_ALGORITHM_SHA256
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Per-thread read buffers, keyed by size, so that hashing many files doesn't allocate a new buffer for each read.
+g_buffers = threading.local()
+
+def available_algorithms():
+    """Returns the names of the hash algorithms that can be used on this system."""
+    algorithms = [HASH_ALGORITHM_BLAKE2B, HASH_ALGORITHM_BLAKE2S, HASH_ALGORITHM_SHA1, HASH_ALGORITHM_SHA256]
+    if xxhash is not None:
+        algorithms.append(HASH_ALGORITHM_XXH64)
+        if hasattr(xxhash, HASH_ALGORITHM_XXH3_128):
+            algorithms.append(HASH_ALGORITHM_XXH3_128)
+    return algorithms
+
+def new_hash(algorithm=DEFAULT_HASH_ALGORITHM):
+    """Creates a hash object, with update() and hexdigest() methods, for the named algorithm."""
+    if algorithm == HASH_ALGORITHM_XXH64 or algorithm == HASH_ALGORITHM_XXH3_128:
+        if xxhash is None:
+            raise ValueError("The xxhash module is not installed.")
+        return getattr(xxhash, algorithm)()
+    if algorithm not in available_algorithms():
+        raise ValueError("Unsupported hash algorithm: " + algorithm)
+    return hashlib.new(algorithm)
+
+def get_buffer(buffer_size):
+    """Returns this thread's reusable read buffer of the given size."""
+    buffers = getattr(g_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = {}
+        g_buffers.buffers = buffers
+    buffer = buffers.get(buffer_size)
+    if buffer is None:
+        buffer = memoryview(bytearray(buffer_size))
+        buffers[buffer_size] = buffer
+    return buffer
+
+def hash_file(file_name, algorithm=DEFAULT_HASH_ALGORITHM, buffer_size=DEFAULT_BUFFER_SIZE, read_callback=None):
+    """Computes the hash of the specified file, reading it into a reused buffer. If given, read_callback is called with the
+    number of bytes after each read. Returns the hash as a hex string."""
+    hash_algorithm = new_hash(algorithm)
+    buffer = get_buffer(buffer_size)
+    with open(file_name, 'rb', buffering=0) as file:
+        while True:
+            num_read = file.readinto(buffer)
+            if not num_read:
+                break
+            hash_algorithm.update(buffer[:num_read])
+            if read_callback is not None:
+                read_callback(num_read)
+    return hash_algorithm.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="Files to hash")
+    parser.add_argument("--hash-algo", type=str, action="store", default=DEFAULT_HASH_ALGORITHM, choices=available_algorithms(), help="Hash algorithm to use", required=False)
+    parser.add_argument("--buffer-size", type=int, action="store", default=DEFAULT_BUFFER_SIZE // 1024, help="Read buffer size, in KB", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    for file_name in args.files:
+        print(hash_file(file_name, args.hash_algo, args.buffer_size * 1024) + "  " + file_name)
+
+if __name__ == "__main__":
+    main()
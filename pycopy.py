@@ -25,56 +25,711 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import concurrent.futures
+import errno
+import json
 import os
+import shutil
 import sys
-from time import sleep
+import threading
+import time
 
+import hashing
 
-def copy_file(source_file_name, dest_file_name, slow):
-    """Mac OS sometimes sucks with network drives. After trying numerous other methods to fix this, I just wrote a 'slow' copy that writes the file in 1 MB chunks."""
+# The single stream copy starts with this chunk size, then doubles it while chunks take less than FAST_CHUNK_SECONDS and
+# halves it when they take more than SLOW_CHUNK_SECONDS.
+INITIAL_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+FAST_CHUNK_SECONDS = 0.25
+SLOW_CHUNK_SECONDS = 1.0
+
+# When to fsync the destination file.
+FSYNC_NONE = "none"
+FSYNC_END = "end"
+FSYNC_INTERVAL = "interval"
+FSYNC_POLICIES = [FSYNC_NONE, FSYNC_END, FSYNC_INTERVAL]
+DEFAULT_FSYNC_INTERVAL_MB = 64
+
+# Rate limiting. --slow is the same as a limit of SLOW_RATE_MB MB/s. The adaptive limit starts at the given rate (or
+# ADAPTIVE_INITIAL_RATE_MB if there isn't one), halves when the recent write latency climbs to LATENCY_BACKOFF_RATIO times
+# the best seen, and grows by RATE_INCREASE_FACTOR when it doesn't, but only if the limit actually held the copy back since
+# the last adjustment (otherwise it would grow without bound). It's adjusted at most once per RATE_ADJUST_SECONDS. The best
+# latency seen creeps up by BASELINE_LATENCY_DRIFT per second, in case the link has permanently slowed down.
+SLOW_RATE_MB = 4.0
+ADAPTIVE_INITIAL_RATE_MB = 16.0
+MIN_RATE_MB = 0.25
+BURST_SECONDS = 0.25
+LATENCY_BACKOFF_RATIO = 2.0
+LATENCY_SMOOTHING = 0.3
+BASELINE_LATENCY_DRIFT = 0.01
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_FACTOR = 1.1
+RATE_ADJUST_SECONDS = 1.0
+
+# The digest of a copied file can either be trusted (since it was computed from the bytes that were written) or checked by
+# reading the destination back. Either way, it's recorded next to the destination in a file named after the algorithm, in the
+# same format as sha256sum.
+VERIFY_TRUST = "trust"
+VERIFY_READBACK = "readback"
+VERIFY_MODES = [VERIFY_TRUST, VERIFY_READBACK]
+
+# Directory mode copies files smaller than SMALL_FILE_SIZE in batches of up to SMALL_FILE_BATCH_COUNT files or
+# SMALL_FILE_BATCH_BYTES bytes, and queues up to TASKS_IN_FLIGHT_PER_JOB tasks per worker.
+DEFAULT_JOBS = 4
+SMALL_FILE_SIZE = 1024 * 1024
+SMALL_FILE_BATCH_COUNT = 64
+SMALL_FILE_BATCH_BYTES = 16 * 1024 * 1024
+TASKS_IN_FLIGHT_PER_JOB = 2
+
+# The single stream copy saves the hash of each range of this size to a checkpoint file next to the destination file.
+# Without a checkpoint file, this much of the end of an existing destination file is checked before it's resumed.
+CHECKPOINT_FILE_SUFFIX = ".pycopy-checkpoint"
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+CHECKPOINT_HASH_ALGORITHM = hashing.HASH_ALGORITHM_BLAKE2B
+TAIL_VERIFY_SIZE = 64 * 1024
+VERIFY_BUFFER_SIZE = 1024 * 1024
+
+# Ranged (--streams) copies read and write this much at a time, and save their progress to a state file next to the
+# destination file at most this often.
+RANGE_CHUNK_SIZE = 1024 * 1024
+STATE_FILE_SUFFIX = ".pycopy"
+STATE_SAVE_INTERVAL_SECONDS = 1.0
+
+
+def hash_range(file_name, start, end):
+    """Hashes the given range of the file."""
+    range_hash = hashing.new_hash(CHECKPOINT_HASH_ALGORITHM)
+    with open(file_name, mode='rb', buffering=0) as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            contents = file.read(min(VERIFY_BUFFER_SIZE, remaining))
+            if not contents:
+                return None
+            range_hash.update(contents)
+            remaining = remaining - len(contents)
+    return range_hash.hexdigest()
+
+def is_sparse(file_stat):
+    """Returns True if the file has holes (fewer blocks allocated than its size needs) and the OS can tell us where they are."""
+    return hasattr(os, 'SEEK_DATA') and hasattr(file_stat, 'st_blocks') and file_stat.st_blocks * 512 < file_stat.st_size
+
+def next_data_extent(fd, offset, end):
+    """Finds the first extent of data at or after the offset, using SEEK_DATA and SEEK_HOLE. Returns a (start, end) tuple,
+    clipped to the given end, or None if there's only a hole from the offset to the end."""
+    try:
+        data_start = os.lseek(fd, offset, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return None
+        raise
+    if data_start >= end:
+        return None
+    return data_start, min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+
+def update_digest_from_file(digest, file_name, start, end):
+    """Adds the given range of the file to the digest."""
+    with open(file_name, mode='rb', buffering=0) as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            contents = file.read(min(VERIFY_BUFFER_SIZE, remaining))
+            if not contents:
+                raise IOError("The source file is shorter than expected, it may have changed during the copy.")
+            digest.update(contents)
+            remaining = remaining - len(contents)
+
+def update_digest_with_zeros(digest, num_bytes):
+    """Adds the zeros that a hole in a sparse file reads as to the digest."""
+    zeros = bytes(min(VERIFY_BUFFER_SIZE, num_bytes))
+    while num_bytes > 0:
+        digest.update(zeros[:min(len(zeros), num_bytes)])
+        num_bytes = num_bytes - len(zeros)
+
+def drop_cached_pages(file_name):
+    """Flushes the file to disk and asks the OS to forget its cached pages, so that reading it back reads what's actually on the disk."""
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def digest_file_name_for(dest_file_name, digest_algorithm):
+    """Returns the name of the file that records the digest of a copied file."""
+    return dest_file_name + "." + digest_algorithm
+
+def save_digest(dest_file_name, digest_algorithm, digest_str):
+    """Writes the digest next to the destination file, in the sha256sum format, so it can be checked with the usual tools."""
+    digest_file_name = digest_file_name_for(dest_file_name, digest_algorithm)
+    temp_file_name = digest_file_name + ".tmp"
+    with open(temp_file_name, 'w') as digest_file:
+        digest_file.write(digest_str + "  " + os.path.basename(dest_file_name) + "\n")
+    os.replace(temp_file_name, digest_file_name)
+
+def checkpoint_file_name_for(dest_file_name):
+    """Returns the name of the file that records the checkpoints of a single stream copy."""
+    return dest_file_name + CHECKPOINT_FILE_SUFFIX
+
+def save_checkpoints(source_stat, dest_file_name, checkpoints):
+    """Writes the checkpoints to the checkpoint file. It's written to a temporary file first so that it's never left half written."""
+    checkpoint_file_name = checkpoint_file_name_for(dest_file_name)
+    temp_file_name = checkpoint_file_name + ".tmp"
+    with open(temp_file_name, 'w') as checkpoint_file:
+        json.dump({ 'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns, 'checkpoints': checkpoints }, checkpoint_file)
+    os.replace(temp_file_name, checkpoint_file_name)
+
+def resume_offset(source_file_name, dest_file_name, source_stat):
+    """Works out where an interrupted copy can safely pick up from. If there's a checkpoint file for this version of the source
+    then only the most recent checkpoint is verified, stepping back a checkpoint at a time if it doesn't match. Without one,
+    the last few KB of the existing destination are compared against the source instead of blindly trusting its size.
+    Returns the offset and the list of checkpoints that are still good, each of which is [start, end, hash of that range].
+    Holes in sparse files are recorded with a hash of None, and are good as long as the destination extends past them."""
+    if not os.path.isfile(dest_file_name):
+        return 0, []
+    dest_size = os.path.getsize(dest_file_name)
+
+    checkpoint_file_name = checkpoint_file_name_for(dest_file_name)
+    if os.path.isfile(checkpoint_file_name):
+        try:
+            with open(checkpoint_file_name, 'r') as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state['size'] != source_stat.st_size or state['mtime_ns'] != source_stat.st_mtime_ns:
+                return 0, []
+            checkpoints = state['checkpoints']
+        except (ValueError, KeyError):
+            return 0, []
+        while len(checkpoints) > 0:
+            start, end, range_hash = checkpoints[-1]
+            if end <= dest_size and (range_hash is None or hash_range(dest_file_name, start, end) == range_hash):
+                return end, checkpoints
+            checkpoints.pop()
+        return 0, []
+
+    # Left by something that didn't write checkpoints, so check the end of what's there.
+    if dest_size > source_stat.st_size:
+        return 0, []
+    tail_start = max(0, dest_size - TAIL_VERIFY_SIZE)
+    if hash_range(dest_file_name, tail_start, dest_size) != hash_range(source_file_name, tail_start, dest_size):
+        return 0, []
+    return dest_size, []
+
+def adapt_chunk_size(chunk_size, elapsed):
+    """Grows the chunk size while chunks are completing quickly, and shrinks it when they're slow, so that the copy keeps
+    making visible progress on slow links without wasting time on tiny writes on fast ones."""
+    if elapsed < FAST_CHUNK_SECONDS:
+        return min(chunk_size * 2, MAX_CHUNK_SIZE)
+    if elapsed > SLOW_CHUNK_SECONDS:
+        return max(chunk_size // 2, MIN_CHUNK_SIZE)
+    return chunk_size
+
+class RateLimiter(object):
+    """Token bucket that limits the copy to a number of bytes per second. In adaptive mode the rate backs off when writes to
+    the destination start taking longer, which is how overloaded network drives show it, and speeds back up as they recover.
+    Shared by all of the streams of a ranged copy."""
+
+    def __init__(self, max_bytes_per_sec, adaptive):
+        self.max_rate = max_bytes_per_sec
+        self.adaptive = adaptive
+        if max_bytes_per_sec is not None:
+            self.rate = float(max_bytes_per_sec)
+        else:
+            self.rate = ADAPTIVE_INITIAL_RATE_MB * 1024 * 1024
+        self.tokens = 0.0
+        self.last_refill = time.time()
+        self.last_adjust = self.last_refill
+        self.last_drift = self.last_refill
+        self.throttled = False
+        self.baseline_latency = None
+        self.recent_latency = None
+        self.lock = threading.Lock()
+
+    def throttle(self, num_bytes):
+        """Waits until the bytes can be transferred without exceeding the current rate."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens = self.tokens - num_bytes
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if delay > 0:
+                self.throttled = True
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_write(self, num_bytes, elapsed):
+        """Takes note of how long a write took, adjusting the rate if in adaptive mode."""
+        if not self.adaptive or num_bytes == 0:
+            return
+        latency = elapsed * (1024 * 1024) / num_bytes
+        with self.lock:
+            if self.recent_latency is None:
+                self.recent_latency = latency
+                self.baseline_latency = latency
+            self.recent_latency = self.recent_latency + LATENCY_SMOOTHING * (latency - self.recent_latency)
+
+            # The baseline is the best latency we've seen, but it creeps up slowly (by time, not by the number of writes, so
+            # that it doesn't catch up with a slow down any faster on a fast link) in case the link has permanently slowed down.
+            now = time.time()
+            drift = 1.0 + BASELINE_LATENCY_DRIFT * (now - self.last_drift)
+            self.last_drift = now
+            self.baseline_latency = min(self.recent_latency, self.baseline_latency * drift)
+
+            if now - self.last_adjust < RATE_ADJUST_SECONDS:
+                return
+            self.last_adjust = now
+            if self.recent_latency > self.baseline_latency * LATENCY_BACKOFF_RATIO:
+                self.rate = max(MIN_RATE_MB * 1024 * 1024, self.rate * RATE_DECREASE_FACTOR)
+            elif self.throttled:
+                self.rate = self.rate * RATE_INCREASE_FACTOR
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, float(self.max_rate))
+            self.throttled = False
+
+def copy_file(source_file_name, dest_file_name, rate_limiter=None, fsync_policy=FSYNC_END, fsync_interval=DEFAULT_FSYNC_INTERVAL_MB * 1024 * 1024, show_progress=True, digest=None):
+    """Mac OS sometimes sucks with network drives. After trying numerous other methods to fix this, I just wrote a copy that
+    can be resumed. The destination is kept open for the whole copy, and a checkpoint (the hash of each completed range) is
+    saved every so often so that a resumed copy only has to verify the last one. Holes in sparse files are skipped rather
+    than copied, so they stay holes in the destination. If a hash object is given as the digest, the whole of the source is
+    added to it as it's copied, starting with the part copied by an earlier run. Returns the number of bytes copied."""
+    source_stat = os.stat(source_file_name)
+    sparse = is_sparse(source_stat)
 
     # Has the file already been (partially) copied?
-    if os.path.isfile(dest_file_name):
-        offset = os.path.getsize(dest_file_name)
-    else:
-        offset = 0
+    offset, checkpoints = resume_offset(source_file_name, dest_file_name, source_stat)
+    if digest is not None:
+        update_digest_from_file(digest, source_file_name, 0, offset)
 
     # Copy the rest of the file.
-    with open(source_file_name, mode='rb') as source_file:
+    with open(source_file_name, mode='rb', buffering=0) as source_file, open(dest_file_name, mode='r+b' if os.path.isfile(dest_file_name) else 'wb') as dest_file:
 
-        # Skip past any part that we've already copied.
-        source_file.seek(offset, 0)
+        # Skip past any part that we've already copied, and throw away anything after it that we couldn't verify.
+        source_file.seek(offset)
+        dest_file.truncate(offset)
+        dest_file.seek(offset)
 
         # Copy the rest.
-        done = False
-        while not done:
-            with open(dest_file_name, mode='ab+') as dest_file:
-                # Read.
-                contents = source_file.read(1024*1024)
-                if not contents:
-                    print('done')
-                    done = True
+        chunk_size = INITIAL_CHUNK_SIZE
+        range_start = offset
+        range_hash = hashing.new_hash(CHECKPOINT_HASH_ALGORITHM)
+        unsynced = 0
+        num_copied = 0
+        data_end = None
+        while True:
+            chunk_start_time = time.time()
+
+            # Sparse file? Skip over any hole. Since checkpoint hashes only cover data, the current range ends at the hole,
+            # and the hole gets its own entry.
+            if sparse and (data_end is None or offset >= data_end):
+                extent = next_data_extent(source_file.fileno(), offset, source_stat.st_size)
+                data_start, data_end = extent if extent is not None else (source_stat.st_size, source_stat.st_size)
+                if data_start > offset:
+                    if digest is not None:
+                        update_digest_with_zeros(digest, data_start - offset)
+                    if offset > range_start:
+                        checkpoints.append([range_start, offset, range_hash.hexdigest()])
+                    checkpoints.append([offset, data_start, None])
+                    offset = data_start
+                    range_start = offset
+                    range_hash = hashing.new_hash(CHECKPOINT_HASH_ALGORITHM)
+                    dest_file.seek(offset)
+                if extent is None:
                     break
 
-                # Write.
-                dest_file.write(contents)
+                # Looking for the data moved the source's file position, so put it back.
+                source_file.seek(offset)
+
+            # Read.
+            contents = source_file.read(chunk_size if not sparse else min(chunk_size, data_end - offset))
+            if not contents:
+                break
+
+            # Write, keeping to the rate limit.
+            if rate_limiter is not None:
+                rate_limiter.throttle(len(contents))
+            write_start_time = time.time()
+            dest_file.write(contents)
+            if rate_limiter is not None:
+                rate_limiter.record_write(len(contents), time.time() - write_start_time)
+            range_hash.update(contents)
+            if digest is not None:
+                digest.update(contents)
+            offset = offset + len(contents)
+            num_copied = num_copied + len(contents)
+            unsynced = unsynced + len(contents)
+            if fsync_policy == FSYNC_INTERVAL and unsynced >= fsync_interval:
+                dest_file.flush()
+                os.fsync(dest_file.fileno())
+                unsynced = 0
+
+            # Checkpoint.
+            if offset - range_start >= CHECKPOINT_INTERVAL:
 
-                # Flush all the buffers.
-                source_file.flush()
+                # Only the last checkpoint is verified on resume, so everything before it has to really be on the disk.
                 dest_file.flush()
+                os.fsync(dest_file.fileno())
+                checkpoints.append([range_start, offset, range_hash.hexdigest()])
+                save_checkpoints(source_stat, dest_file_name, checkpoints)
+                range_start = offset
+                range_hash = hashing.new_hash(CHECKPOINT_HASH_ALGORITHM)
 
-                # Print something so we know it's still working.
+            # Print something so we know it's still working.
+            if show_progress:
                 print('.', end='', flush=True)
 
-                # Slow mode.
-                if slow:
-                    sleep(0.25)
+            # A rate limited copy sticks to 1 MB chunks so that it doesn't alternate between long bursts and long waits.
+            if rate_limiter is None:
+                chunk_size = adapt_chunk_size(chunk_size, time.time() - chunk_start_time)
+
+        # A hole at the end of the file doesn't get written, so set the size explicitly.
+        if sparse:
+            dest_file.truncate(offset)
+
+        dest_file.flush()
+        if fsync_policy != FSYNC_NONE:
+            os.fsync(dest_file.fileno())
+
+    # The copy is complete, so the checkpoints are no longer needed.
+    if os.path.isfile(checkpoint_file_name_for(dest_file_name)):
+        os.remove(checkpoint_file_name_for(dest_file_name))
+    if show_progress:
+        print('done')
+    return num_copied
+
+def state_file_name_for(dest_file_name):
+    """Returns the name of the file that records the progress of a ranged copy."""
+    return dest_file_name + STATE_FILE_SUFFIX
+
+def split_ranges(start, end, num_ranges):
+    """Splits [start, end) into roughly equal ranges. Each range is [start, end, offset copied up to]."""
+    ranges = []
+    range_size = max(1, (end - start + num_ranges - 1) // num_ranges)
+    while start < end:
+        ranges.append([start, min(start + range_size, end), start])
+        start = start + range_size
+    return ranges
+
+def load_ranges(source_file_name, dest_file_name, num_ranges):
+    """Works out which parts of the file still need to be copied. Progress is taken from the state file if there is one
+    and it's for the same version of the source file. Otherwise whatever part of an existing destination file the single
+    stream copy would resume from is treated as a completed first range. Returns a list of ranges, each of which is [start, end,
+    offset copied up to], and the size the destination must be cut down to before copying (None if it can be used as is),
+    since anything past the verified part of it may not match the source, and a sparse copy won't overwrite its holes."""
+    source_stat = os.stat(source_file_name)
+    state_file_name = state_file_name_for(dest_file_name)
+    if os.path.isfile(state_file_name) and os.path.isfile(dest_file_name):
+        try:
+            with open(state_file_name, 'r') as state_file:
+                state = json.load(state_file)
+            if state['size'] == source_stat.st_size and state['mtime_ns'] == source_stat.st_mtime_ns:
+                return state['ranges'], None
+        except (ValueError, KeyError):
+            pass
+    elif os.path.isfile(dest_file_name):
+        copied, _ = resume_offset(source_file_name, dest_file_name, source_stat)
+        return [[0, copied, copied]] + split_ranges(copied, source_stat.st_size, num_ranges), copied
+    return split_ranges(0, source_stat.st_size, num_ranges), 0
+
+def save_ranges(source_file_name, dest_file_name, ranges):
+    """Writes the progress of a ranged copy to the state file. It's written to a temporary file first so that it's never left half written."""
+    source_stat = os.stat(source_file_name)
+    state_file_name = state_file_name_for(dest_file_name)
+    temp_file_name = state_file_name + ".tmp"
+    with open(temp_file_name, 'w') as state_file:
+        json.dump({ 'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns, 'ranges': ranges }, state_file)
+    os.replace(temp_file_name, state_file_name)
+
+def preallocate(dest_fd, size, sparse=False):
+    """Sets the size of the destination file, reserving the space for it if the file system supports it. Space isn't reserved
+    for sparse files, since that would fill in their holes."""
+    if sparse or os.fstat(dest_fd).st_size >= size:
+        os.ftruncate(dest_fd, size)
+        return
+    try:
+        os.posix_fallocate(dest_fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(dest_fd, size)
+
+def copy_range(source_fd, dest_fd, file_range, rate_limiter, save_progress, stopped, show_progress, sparse=False):
+    """Copies one range of a ranged copy, using positioned reads and writes so that the ranges can share file descriptors.
+    For sparse files, only the data within the range is copied; the destination already has holes everywhere else."""
+    _, end, offset = file_range
+    num_copied = 0
+    data_end = None if sparse else end
+    while offset < end and not stopped.is_set():
+        if data_end is None or offset >= data_end:
+            extent = next_data_extent(source_fd, offset, end)
+            if extent is None:
+                file_range[2] = end
+                save_progress()
+                break
+            offset, data_end = extent
+        contents = os.pread(source_fd, min(RANGE_CHUNK_SIZE, data_end - offset), offset)
+        if not contents:
+            raise IOError("The source file is shorter than expected, it may have changed during the copy.")
+        if rate_limiter is not None:
+            rate_limiter.throttle(len(contents))
+        write_start_time = time.time()
+        view = memoryview(contents)
+        while len(view) > 0:
+            num_written = os.pwrite(dest_fd, view, offset)
+            view = view[num_written:]
+            offset = offset + num_written
+        if rate_limiter is not None:
+            rate_limiter.record_write(len(contents), time.time() - write_start_time)
+        num_copied = num_copied + len(contents)
+        file_range[2] = offset
+        save_progress()
+
+        # Print something so we know it's still working.
+        if show_progress:
+            print('.', end='', flush=True)
+    return num_copied
+
+def ranged_copy_file(source_file_name, dest_file_name, streams, rate_limiter=None, show_progress=True):
+    """Copies the file as several ranges at once, for network file systems that only reach full speed with several requests
+    outstanding. The destination is preallocated and each range is written in place. Progress is saved per range, so an
+    interrupted copy can be resumed, even with a different number of streams. Holes in sparse files are left as holes.
+    Returns the number of bytes copied."""
+    ranges, truncate_size = load_ranges(source_file_name, dest_file_name, streams)
+    source_stat = os.stat(source_file_name)
+    sparse = is_sparse(source_stat)
+    num_copied = 0
+    state_lock = threading.Lock()
+    stopped = threading.Event()
+    last_save = [time.time()]
+
+    source_fd = os.open(source_file_name, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest_file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # Record the plan before the destination grows to full size, since once it has, its size says nothing about how much has been copied.
+            save_ranges(source_file_name, dest_file_name, ranges)
+            if truncate_size is not None:
+                os.ftruncate(dest_fd, truncate_size)
+            preallocate(dest_fd, source_stat.st_size, sparse)
+
+            def save_progress(force=False):
+                """Saves the progress of all the ranges, if it hasn't been done recently. The data is flushed to disk first so
+                that the state file never claims more than has actually been written."""
+                with state_lock:
+                    now = time.time()
+                    if force or now - last_save[0] >= STATE_SAVE_INTERVAL_SECONDS:
+
+                        # The other streams keep writing, so copy the progress first and only save what was written before the fsync.
+                        snapshot = [ list(file_range) for file_range in ranges ]
+                        os.fsync(dest_fd)
+                        save_ranges(source_file_name, dest_file_name, snapshot)
+                        last_save[0] = now
+
+            # If anything goes wrong (including being interrupted), stop the other ranges and save how far they got.
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+                    futures = [ executor.submit(copy_range, source_fd, dest_fd, file_range, rate_limiter, save_progress, stopped, show_progress, sparse) for file_range in ranges if file_range[2] < file_range[1] ]
+                    try:
+                        for future in futures:
+                            num_copied = num_copied + future.result()
+                    except:
+                        stopped.set()
+                        raise
+            finally:
+                save_progress(True)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+
+    # The copy is complete, so the state file (and any checkpoints from a single stream copy) are no longer needed.
+    os.remove(state_file_name_for(dest_file_name))
+    if os.path.isfile(checkpoint_file_name_for(dest_file_name)):
+        os.remove(checkpoint_file_name_for(dest_file_name))
+    if show_progress:
+        print('done')
+    return num_copied
+
+def copy_one_file(source_file_name, dest_file_name, streams, rate_limiter, fsync_policy, fsync_interval, show_progress=True, digest_algorithm=None, verify=VERIFY_TRUST):
+    """Copies a file with either the ranged or the single stream copy. If a digest algorithm is given, the digest of the source
+    is recorded next to the destination, after optionally reading the destination back to check it. If that check fails, the
+    destination is removed and IOError is raised. Returns the number of bytes copied."""
+    digest = hashing.new_hash(digest_algorithm) if digest_algorithm is not None else None
+
+    # A state file means a ranged copy was interrupted, and the destination's size no longer says how much has been copied.
+    if streams > 1 or os.path.isfile(state_file_name_for(dest_file_name)):
+        num_copied = ranged_copy_file(source_file_name, dest_file_name, max(1, streams), rate_limiter, show_progress)
+
+        # The ranges arrive out of order, so the digest has to be computed afterwards.
+        if digest is not None:
+            update_digest_from_file(digest, source_file_name, 0, os.path.getsize(source_file_name))
+    else:
+        num_copied = copy_file(source_file_name, dest_file_name, rate_limiter, fsync_policy, fsync_interval, show_progress, digest)
+
+    if digest is not None:
+        digest_str = digest.hexdigest()
+        if verify == VERIFY_READBACK:
+            drop_cached_pages(dest_file_name)
+            if hashing.hash_file(dest_file_name, digest_algorithm, VERIFY_BUFFER_SIZE) != digest_str:
+
+                # Don't leave a bad copy for the next run to resume from.
+                os.remove(dest_file_name)
+                raise IOError(dest_file_name + " does not match " + source_file_name + " after copying, so it was removed.")
+        save_digest(dest_file_name, digest_algorithm, digest_str)
+        if show_progress:
+            print(digest_str + "  " + dest_file_name)
+    return num_copied
+
+def list_transfers(source_dir, dest_dir, file_list_name, totals, totals_lock):
+    """Yields a (source file, destination file, size) tuple for each file to copy: either the ones named in the file list,
+    one per line and relative to the source directory, or everything under the source directory. Files that can't be
+    found, and list entries that point outside the source directory, are reported and counted as failures."""
+
+    def failed(name, reason):
+        """Reports a file that can't be copied."""
+        print("Exception with " + name + ": " + reason)
+        with totals_lock:
+            totals['failed'] += 1
+
+    def transfer(relative_name):
+        """Returns the transfer for a file, or None if its size can't be read."""
+        source_file_name = os.path.join(source_dir, relative_name)
+        try:
+            return source_file_name, os.path.join(dest_dir, relative_name), os.path.getsize(source_file_name)
+        except OSError as e:
+            failed(source_file_name, str(e))
+            return None
+
+    if file_list_name is not None:
+        with open(file_list_name, 'r') as file_list:
+            for line in file_list:
+                name = line.rstrip('\r\n')
+                if len(name) == 0:
+                    continue
+                relative_name = os.path.normpath(os.path.relpath(name, source_dir) if os.path.isabs(name) else name)
+                if os.path.isabs(relative_name) or relative_name == os.pardir or relative_name.startswith(os.pardir + os.sep):
+                    failed(name, "not inside " + source_dir)
+                    continue
+                file_transfer = transfer(relative_name)
+                if file_transfer is not None:
+                    yield file_transfer
+        return
+
+    for root, dir_names, file_names in os.walk(source_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            source_file_name = os.path.join(root, file_name)
+            if not os.path.isfile(source_file_name):
+                continue
+            file_transfer = transfer(os.path.relpath(source_file_name, source_dir))
+            if file_transfer is not None:
+                yield file_transfer
+
+def is_up_to_date(source_file_name, dest_file_name):
+    """A finished copy has the same size and modification time as its source (since they're copied over when it completes),
+    and no leftover state or checkpoint files."""
+    try:
+        source_stat = os.stat(source_file_name)
+        dest_stat = os.stat(dest_file_name)
+    except OSError:
+        return False
+    return source_stat.st_size == dest_stat.st_size and source_stat.st_mtime_ns == dest_stat.st_mtime_ns and \
+        not os.path.exists(state_file_name_for(dest_file_name)) and not os.path.exists(checkpoint_file_name_for(dest_file_name))
+
+def is_older_copy(source_file_name, dest_file_name):
+    """An interrupted copy either left a state or checkpoint file behind, or is shorter than its source. A destination that
+    has neither is a finished copy of an older version of the source, which can't be resumed from (its tail may well match
+    even though something before it changed), so it has to be copied again from the start."""
+    if os.path.exists(state_file_name_for(dest_file_name)) or os.path.exists(checkpoint_file_name_for(dest_file_name)):
+        return False
+    try:
+        return os.path.getsize(dest_file_name) >= os.path.getsize(source_file_name)
+    except OSError:
+        return False
+
+def copy_transfers(transfers, streams, rate_limiter, fsync_policy, fsync_interval, digest_algorithm, verify, totals, totals_lock):
+    """Worker task for the tree copy. Copies one large file or a batch of small ones, adding the results to the totals."""
+    for source_file_name, dest_file_name, _ in transfers:
+        try:
+            if is_up_to_date(source_file_name, dest_file_name):
+                with totals_lock:
+                    totals['skipped'] += 1
+                continue
+            dest_dir = os.path.dirname(dest_file_name)
+            if len(dest_dir) > 0 and not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir, exist_ok=True)
+            if is_older_copy(source_file_name, dest_file_name):
+                os.remove(dest_file_name)
+            num_copied = copy_one_file(source_file_name, dest_file_name, streams, rate_limiter, fsync_policy, fsync_interval, False, digest_algorithm, verify)
+            shutil.copystat(source_file_name, dest_file_name)
+            print("Copied " + source_file_name + " (" + str(num_copied) + " bytes)")
+            with totals_lock:
+                totals['copied'] += 1
+                totals['bytes'] += num_copied
+        except Exception as e:
+            print("Exception with " + source_file_name + ": " + str(e))
+            with totals_lock:
+                totals['failed'] += 1
+
+def copy_tree(source_dir, dest_dir, file_list_name=None, jobs=DEFAULT_JOBS, streams=1, rate_limiter=None, fsync_policy=FSYNC_END, fsync_interval=DEFAULT_FSYNC_INTERVAL_MB * 1024 * 1024, digest_algorithm=None, verify=VERIFY_TRUST):
+    """Copies a directory tree (or the files in a list) in one run. The files are listed as the copy goes and handed to a
+    pool of workers through a bounded queue. Small files are batched together so the workers aren't dominated by per-file
+    overhead, and large files get a worker to themselves (and --streams, if given). Each file resumes the same way a single
+    file copy does, files that were already completely copied are skipped, and finished copies of an older version are
+    copied again. Prints a summary at the end."""
+    totals = collections.Counter()
+    totals_lock = threading.Lock()
+    start_time = time.time()
+
+    pending = collections.deque()
+    batch = []
+    batch_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit(transfers):
+            """Queues the transfers, waiting for the oldest task to finish if the queue is full."""
+            while len(pending) >= jobs * TASKS_IN_FLIGHT_PER_JOB:
+                pending.popleft().result()
+            pending.append(executor.submit(copy_transfers, transfers, streams, rate_limiter, fsync_policy, fsync_interval, digest_algorithm, verify, totals, totals_lock))
+
+        for transfer in list_transfers(source_dir, dest_dir, file_list_name, totals, totals_lock):
+            file_size = transfer[2]
+            if file_size >= SMALL_FILE_SIZE:
+                submit([transfer])
+                continue
+            batch.append(transfer)
+            batch_bytes = batch_bytes + file_size
+            if len(batch) >= SMALL_FILE_BATCH_COUNT or batch_bytes >= SMALL_FILE_BATCH_BYTES:
+                submit(batch)
+                batch = []
+                batch_bytes = 0
+        if len(batch) > 0:
+            submit(batch)
+        for future in pending:
+            future.result()
+
+    elapsed = time.time() - start_time
+    mb_per_sec = totals['bytes'] / (1024.0 * 1024.0) / elapsed if elapsed > 0 else 0.0
+    print(str(totals['copied']) + " files copied, " + str(totals['skipped']) + " already up to date, " + str(totals['failed']) + " failed; " +
+        str(totals['bytes']) + " bytes in " + "{:.1f}".format(elapsed) + " seconds (" + "{:.1f}".format(mb_per_sec) + " MB/s).")
+    return totals['failed'] == 0
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--source-file", type=str, action="store", default="", help="File to read", required=True)
-    parser.add_argument("--dest-file", type=str, action="store", default="", help="File to write", required=True)
-    parser.add_argument("--slow", action="store_true", default=False, help="Makes the copy run slowly; this was just to get around bugs in mac os", required=False)
+    parser.add_argument("--source-file", type=str, action="store", default=None, help="File to read", required=False)
+    parser.add_argument("--dest-file", type=str, action="store", default=None, help="File to write", required=False)
+    parser.add_argument("--source-dir", type=str, action="store", default=None, help="Directory to copy, instead of a single file", required=False)
+    parser.add_argument("--dest-dir", type=str, action="store", default=None, help="Directory to copy into", required=False)
+    parser.add_argument("--file-list", type=str, action="store", default=None, help="File listing the files to copy, one per line and relative to --source-dir, instead of the whole directory", required=False)
+    parser.add_argument("--jobs", type=int, action="store", default=DEFAULT_JOBS, help="Number of files to copy at once in directory mode", required=False)
+    parser.add_argument("--streams", type=int, action="store", default=1, help="Number of parts of the file to copy at once", required=False)
+    parser.add_argument("--fsync", type=str, action="store", default=FSYNC_END, choices=FSYNC_POLICIES, help="When to flush the destination file to disk: never, at the end, or every --fsync-interval MB", required=False)
+    parser.add_argument("--fsync-interval", type=int, action="store", default=DEFAULT_FSYNC_INTERVAL_MB, help="With --fsync interval, the number of MB to write between each fsync", required=False)
+    parser.add_argument("--rate", type=float, action="store", default=None, help="Maximum copy rate, in MB/s", required=False)
+    parser.add_argument("--adaptive-rate", action="store_true", default=False, help="Back off when writes to the destination slow down, and speed up again when they recover (up to --rate, if given)", required=False)
+    parser.add_argument("--digest", type=str, action="store", default=None, choices=hashing.available_algorithms(), help="Compute the digest of each file as it's copied, and record it next to the destination", required=False)
+    parser.add_argument("--verify", type=str, action="store", default=VERIFY_TRUST, choices=VERIFY_MODES, help="Whether to trust the digest computed during the copy or to check it by reading the destination back", required=False)
+    parser.add_argument("--slow", action="store_true", default=False, help="Makes the copy run slowly (the same as --rate " + str(SLOW_RATE_MB) + "); this was just to get around bugs in mac os", required=False)
 
     try:
         args = parser.parse_args()
@@ -82,7 +737,30 @@ def main():
         parser.error(e)
         sys.exit(1)
 
-    copy_file(args.source_file, args.dest_file, args.slow)
+    rate_limiter = None
+    max_rate = args.rate
+    if max_rate is None and args.slow:
+        max_rate = SLOW_RATE_MB
+    if max_rate is not None or args.adaptive_rate:
+        rate_limiter = RateLimiter(int(max_rate * 1024 * 1024) if max_rate is not None else None, args.adaptive_rate)
+
+    # Reading back the destination needs something to compare it against.
+    digest_algorithm = args.digest
+    if digest_algorithm is None and args.verify == VERIFY_READBACK:
+        digest_algorithm = hashing.DEFAULT_HASH_ALGORITHM
+
+    if args.source_dir is not None and args.dest_dir is not None:
+        if not copy_tree(args.source_dir, args.dest_dir, args.file_list, max(1, args.jobs), args.streams, rate_limiter, args.fsync, args.fsync_interval * 1024 * 1024, digest_algorithm, args.verify):
+            sys.exit(1)
+    elif args.source_file is not None and args.dest_file is not None:
+        try:
+            copy_one_file(args.source_file, args.dest_file, args.streams, rate_limiter, args.fsync, args.fsync_interval * 1024 * 1024, True, digest_algorithm, args.verify)
+        except IOError as e:
+            print(str(e))
+            sys.exit(1)
+    else:
+        print("Either --source-file and --dest-file, or --source-dir and --dest-dir, must be given.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -25,115 +25,1461 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import errno
 import hashlib
+import heapq
+import itertools
+import json
 import logging
 import os
+import queue
+import select
 import shutil
+import signal
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import traceback
 
+import hashing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Hash cache limits. Entries that haven't been seen for this many days are treated as stale.
+DEFAULT_HASH_CACHE_MAX_ENTRIES = 5000000
+HASH_CACHE_STALE_DAYS = 30
+
+# Files modified this recently (in seconds) are not cached, since a write within the same timestamp
+# granularity would not change the stat signature.
+HASH_CACHE_RACY_SECONDS = 2.0
+
+# Number of cache writes to batch up before committing.
+HASH_CACHE_COMMIT_INTERVAL = 1000
+
+# Number of work items, per job, that the directory walk is allowed to queue ahead of the workers.
+WORK_QUEUE_ITEMS_PER_JOB = 8
+
+# File comparison modes.
+COMPARE_HASH = "hash"
+COMPARE_TIERED = "tiered"
+COMPARE_BYTES = "bytes"
+COMPARE_MODES = [COMPARE_HASH, COMPARE_TIERED, COMPARE_BYTES]
+
+# Size of each of the two buffers used when comparing files byte for byte.
+COMPARE_BUFFER_SIZE = 1024 * 1024
+
+# Tiered comparison settings. Timestamps within the tolerance are considered equal, since some file systems
+# (FAT, SMB) store them with coarse resolution.
+MTIME_TOLERANCE_NS = 2 * 1000 * 1000 * 1000
+SAMPLE_BLOCK_SIZE = 65536
+
+# Delta transfer settings. Files smaller than the threshold are always copied in full.
+DELTA_BLOCK_SIZE = 128 * 1024
+DELTA_CHECKSUM_MODULUS = 65536
+DEFAULT_DELTA_THRESHOLD_MB = 64
+DELTA_MAX_UNMATCHED_FRACTION = 0.5 # Give up on a delta copy once more than this fraction of what's been scanned didn't match
+DELTA_MIN_SCAN_BLOCKS = 8          # ...but only after scanning at least this many blocks
+
+# Copy engine methods, in the order they are attempted.
+COPY_METHOD_REFLINK = "reflink"
+COPY_METHOD_COPY_FILE_RANGE = "copy_file_range"
+COPY_METHOD_SENDFILE = "sendfile"
+COPY_METHOD_BUFFERED = "buffered"
+
+# Linux ioctl for sharing the source file's extents with the destination on copy-on-write file systems (btrfs, XFS).
+FICLONE = 0x40049409
+
+# Errors that mean a copy method isn't supported for this pair of files, rather than that the copy failed.
+COPY_METHOD_UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EBADF, errno.EPERM])
+
+# Maximum number of bytes to ask the kernel to copy per call.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Destination manifest, written to the root of the destination directory.
+MANIFEST_FILE_NAME = ".pysync_manifest"
+MANIFEST_VERSION = 1
+
+# Run phases, for timing.
+PHASE_WALK = "walk"
+PHASE_HASH_SOURCE = "hash-source"
+PHASE_HASH_DEST = "hash-dest"
+PHASE_COMPARE = "compare"
+PHASE_COPY = "copy"
+PHASE_FIX_DATES = "fix-dates"
+
+# Number of slowest files to list in the stats report.
+DEFAULT_NUM_SLOWEST_FILES = 10
+
+# Adaptive concurrency settings. Each device's concurrency limit is adjusted once per window, as long as enough data
+# was moved in that window to give a meaningful throughput measurement. A drop in throughput larger than the threshold
+# halves the limit, otherwise the limit goes up by one.
+ADAPT_INITIAL_LIMIT = 2
+ADAPT_WINDOW_SECONDS = 1.0
+ADAPT_MIN_WINDOW_BYTES = 4 * 1024 * 1024
+ADAPT_DECREASE_THRESHOLD = 0.1
+
+# Concurrency and bandwidth controller for the current run, or None if I/O isn't being limited.
+g_io_controller = None
+
+# Per-thread count of bytes moved, used to attribute I/O to devices.
+g_io_bytes = threading.local()
+
+# Hash algorithm and read buffer size used for whole file hashes.
+g_hash_algorithm = hashing.DEFAULT_HASH_ALGORITHM
+g_hash_buffer_size = hashing.DEFAULT_BUFFER_SIZE
+
+# Statistics for the current run, or None if they aren't being collected.
+g_stats = None
+
+# inotify constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 1024 * 1024
+
+# Watch mode settings. Changes are synced once the source has been quiet for the debounce interval, or
+# after the maximum delay if it never goes quiet.
+DEFAULT_WATCH_DEBOUNCE_SECONDS = 2.0
+WATCH_MAX_DELAY_MULTIPLIER = 10
+
+# Pipelined copy settings: the number and size of the buffers passed from the reader thread to the hashing/writing thread.
+COPY_METHOD_PIPELINE = "pipeline"
+PIPELINE_NUM_BUFFERS = 4
+PIPELINE_BUFFER_SIZE = 1024 * 1024
+
+# Per-thread status message buffer, used to keep output ordered when running with multiple jobs.
+g_output = threading.local()
+
+# Per-thread read buffers for byte for byte comparisons, allocated once and reused for every file.
+g_compare_buffers = threading.local()
+
 def log_error(log_str):
     """Writes an error message to the log file."""
     logger = logging.getLogger()
     logger.error(log_str)
 
+def log_info(log_str):
+    """Writes a status message to stdout, or to the calling thread's buffer when running as part of a worker pool."""
+    buffer = getattr(g_output, 'buffer', None)
+    if buffer is None:
+        print(log_str)
+    else:
+        buffer.append(log_str)
+
+def run_buffered(func, *args):
+    """Runs the function, capturing its status messages so that they can be printed in a deterministic order."""
+    g_output.buffer = []
+    try:
+        func(*args)
+        return g_output.buffer
+    finally:
+        g_output.buffer = None
+
+def run_buffered_result(func, *args):
+    """Like run_buffered, but returns both the captured status messages and the function's result."""
+    result = []
+    buffer = run_buffered(lambda: result.append(func(*args)))
+    return buffer, result[0]
+
+def print_buffered(buffer):
+    """Prints status messages that were captured by run_buffered."""
+    for log_str in buffer:
+        print(log_str)
+
+class SyncStats(object):
+    """Collects timing and throughput statistics for a run."""
+
+    def __init__(self, num_slowest=DEFAULT_NUM_SLOWEST_FILES):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.num_slowest = num_slowest
+        self.phase_times = {}
+        self.phase_bytes_read = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files_walked = 0
+        self.bytes_walked = 0
+        self.walk_done = False
+        self.files_processed = 0
+        self.bytes_processed = 0
+        self.files_copied = 0
+        self.slowest = []
+        self.current_phase = threading.local()
+
+    def add_phase_time(self, phase, seconds):
+        """Adds to the time spent in a phase. Since workers run concurrently, phase times can add up to more than the wall time."""
+        with self.lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def add_bytes_read(self, num_bytes):
+        """Counts bytes read from disk, attributing them to the calling thread's current phase."""
+        phase = getattr(self.current_phase, 'name', None)
+        with self.lock:
+            self.bytes_read = self.bytes_read + num_bytes
+            if phase is not None:
+                self.phase_bytes_read[phase] = self.phase_bytes_read.get(phase, 0) + num_bytes
+
+    def add_bytes_written(self, num_bytes):
+        """Counts bytes written to disk."""
+        with self.lock:
+            self.bytes_written = self.bytes_written + num_bytes
+
+    def file_walked(self, file_size):
+        """Called as the walk finds each source file, so that the amount of work remaining is known."""
+        with self.lock:
+            self.files_walked = self.files_walked + 1
+            self.bytes_walked = self.bytes_walked + file_size
+
+    def file_done(self, file_name, file_size, seconds, copied):
+        """Called when a file has been completely processed."""
+        with self.lock:
+            self.files_processed = self.files_processed + 1
+            self.bytes_processed = self.bytes_processed + file_size
+            if copied:
+                self.files_copied = self.files_copied + 1
+            if len(self.slowest) < self.num_slowest:
+                heapq.heappush(self.slowest, (seconds, file_name))
+            elif self.num_slowest > 0 and seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, file_name))
+
+    def finish(self):
+        """Marks the end of the run."""
+        self.end_time = time.time()
+
+    def elapsed(self):
+        """Returns the wall time of the run so far, in seconds."""
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+
+    def progress_str(self):
+        """Returns a one line summary of the progress so far, including throughput and (once the walk is done) an estimated time remaining."""
+        with self.lock:
+            elapsed = self.elapsed()
+            mb_per_sec = 0.0
+            if elapsed > 0:
+                mb_per_sec = (self.bytes_read + self.bytes_written) / (1024.0 * 1024.0) / elapsed
+            progress = "Progress: " + str(self.files_processed) + "/" + str(self.files_walked) + " files, " + "{:.1f}".format(mb_per_sec) + " MB/s, ETA "
+            if self.walk_done and self.bytes_processed > 0:
+                remaining = elapsed * (self.bytes_walked - self.bytes_processed) / self.bytes_processed
+                progress = progress + "{:.0f}".format(remaining) + " s"
+            else:
+                progress = progress + "unknown"
+        return progress
+
+    def report(self):
+        """Returns the statistics as a dictionary, suitable for converting to JSON."""
+        with self.lock:
+            elapsed = self.elapsed()
+            files_per_sec = 0.0
+            mb_per_sec = 0.0
+            if elapsed > 0:
+                files_per_sec = self.files_processed / elapsed
+                mb_per_sec = (self.bytes_read + self.bytes_written) / (1024.0 * 1024.0) / elapsed
+            return {
+                "elapsed_seconds": elapsed,
+                "phase_seconds": dict(self.phase_times),
+                "phase_bytes_read": dict(self.phase_bytes_read),
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "files_walked": self.files_walked,
+                "files_processed": self.files_processed,
+                "files_copied": self.files_copied,
+                "files_per_second": files_per_sec,
+                "mb_per_second": mb_per_sec,
+                "slowest_files": [ { "file": file_name, "seconds": seconds } for seconds, file_name in sorted(self.slowest, reverse=True) ]
+            }
+
+    def write_report(self, file_name):
+        """Writes the JSON report to the specified file, or to stdout if the file name is '-'."""
+        report_str = json.dumps(self.report(), indent=4)
+        if file_name == "-":
+            print(report_str)
+        else:
+            with open(file_name, 'wt') as report_file:
+                report_file.write(report_str + "\n")
+
+class ProgressThread(threading.Thread):
+    """Periodically prints a progress line for the current run."""
+
+    def __init__(self, stats, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopped = threading.Event()
+        self.stats = stats
+        self.interval = interval
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.stats.progress_str(), flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """Context manager that adds the time spent inside it to the given phase, if stats are being collected."""
+    stats = g_stats
+    if stats is None:
+        yield
+        return
+    previous_phase = getattr(stats.current_phase, 'name', None)
+    stats.current_phase.name = phase
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        stats.add_phase_time(phase, time.time() - start_time)
+        stats.current_phase.name = previous_phase
+
+def count_io_bytes(num_bytes):
+    """Counts bytes moved by the calling thread, and applies the bandwidth cap, if there is one."""
+    g_io_bytes.count = getattr(g_io_bytes, 'count', 0) + num_bytes
+    if g_io_controller is not None:
+        g_io_controller.throttle(num_bytes)
+
+def record_bytes_read(num_bytes):
+    """Counts bytes read, if stats are being collected."""
+    if g_stats is not None:
+        g_stats.add_bytes_read(num_bytes)
+    count_io_bytes(num_bytes)
+
+def record_bytes_written(num_bytes):
+    """Counts bytes written, if stats are being collected."""
+    if g_stats is not None:
+        g_stats.add_bytes_written(num_bytes)
+    count_io_bytes(num_bytes)
+
+class DeviceLimiter(object):
+    """Limits the number of concurrent operations on a single device. When adaptive, the limit is tuned with additive
+    increase/multiplicative decrease based on the throughput observed in each measurement window."""
+
+    def __init__(self, device, max_limit, adaptive):
+        self.device = device
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.limit = max_limit
+        if adaptive:
+            self.limit = min(ADAPT_INITIAL_LIMIT, max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.total_bytes = 0
+        self.previous_mb_per_sec = None
+        self.last_mb_per_sec = 0.0
+
+    def acquire(self):
+        """Waits for a free slot on the device."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self, num_bytes):
+        """Frees a slot, recording the number of bytes the operation moved."""
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.window_bytes = self.window_bytes + num_bytes
+            self.total_bytes = self.total_bytes + num_bytes
+            if self.adaptive:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        """Ends the measurement window, if it's complete, and adjusts the limit. Caller must hold the condition's lock."""
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < ADAPT_WINDOW_SECONDS or self.window_bytes < ADAPT_MIN_WINDOW_BYTES:
+            return
+        mb_per_sec = self.window_bytes / (1024.0 * 1024.0) / elapsed
+        if self.previous_mb_per_sec is not None and mb_per_sec < self.previous_mb_per_sec * (1.0 - ADAPT_DECREASE_THRESHOLD):
+            self.limit = max(1, self.limit // 2)
+        elif self.limit < self.max_limit:
+            self.limit = self.limit + 1
+        self.previous_mb_per_sec = mb_per_sec
+        self.last_mb_per_sec = mb_per_sec
+        self.window_start = now
+        self.window_bytes = 0
+
+class IOController(object):
+    """Limits concurrent I/O per device and, optionally, total bandwidth using a token bucket."""
+
+    def __init__(self, max_limit, adaptive, max_mb_per_sec=None):
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.rate = None
+        if max_mb_per_sec is not None:
+            self.rate = max_mb_per_sec * 1024.0 * 1024.0
+        self.tokens = 0.0
+        self.last_refill = time.time()
+
+    def limiter(self, device):
+        """Returns the limiter for a device, creating it if necessary."""
+        with self.lock:
+            limiter = self.devices.get(device)
+            if limiter is None:
+                limiter = DeviceLimiter(device, self.max_limit, self.adaptive)
+                self.devices[device] = limiter
+            return limiter
+
+    @contextlib.contextmanager
+    def slot(self, devices):
+        """Context manager that holds a slot on each of the given devices. Slots are always taken in the same order to avoid deadlocks."""
+        limiters = [ self.limiter(device) for device in sorted(set(devices)) ]
+        for limiter in limiters:
+            limiter.acquire()
+        start_count = getattr(g_io_bytes, 'count', 0)
+        try:
+            yield
+        finally:
+            num_bytes = getattr(g_io_bytes, 'count', 0) - start_count
+            for limiter in limiters:
+                limiter.release(num_bytes)
+
+    def throttle(self, num_bytes):
+        """Spends tokens for the given number of bytes, sleeping if the bucket is in debt."""
+        if self.rate is None:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens = self.tokens - num_bytes
+            delay = 0.0
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def summary(self):
+        """Returns a line per device describing its final concurrency limit and most recent throughput."""
+        with self.lock:
+            limiters = sorted(self.devices.values(), key=lambda limiter: limiter.device)
+        return [ "Device " + str(limiter.device) + ": concurrency " + str(limiter.limit) + ", " + "{:.1f}".format(limiter.last_mb_per_sec) + " MB/s, " + str(limiter.total_bytes) + " bytes" for limiter in limiters ]
+
+@contextlib.contextmanager
+def io_phase(phase, *devices):
+    """Context manager for an I/O operation: times it as the given phase and, if I/O is being limited, holds a slot on each device."""
+    with timed_phase(phase):
+        if g_io_controller is None:
+            yield
+        else:
+            with g_io_controller.slot(devices):
+                yield
+
+def dest_device(dest_file_name, dest_entry):
+    """Returns the device of the destination file, or of its directory if it doesn't exist yet."""
+    if dest_entry is not None:
+        return dest_entry.stat().st_dev
+    return os.stat(os.path.dirname(os.path.abspath(dest_file_name))).st_dev
+
 def normjoin(*args):
     return os.path.normpath(os.path.join(*args))
 
 def fix_file_dates(source_file_name, dest_file_name):
     """Sets the destination files creation and modification dates equal to those of the source file."""
     shutil.copystat(source_file_name, dest_file_name)
-    print("Fixed dates for " + dest_file_name)
-
-def copy_file(source_file_name, dest_file_name):
-    """Copies the source file to the complete path given by the destination file name."""
-    print("Copying " + source_file_name + " to " + dest_file_name)
-    shutil.copy2(source_file_name, dest_file_name)
-    print("Copying done.")
-
-def hash_file(file_to_hash):
-    """Computes a SHA-256 hash of the specified file."""
-    print("Hashing " + file_to_hash + "...")
-    hash_algorithm = hashlib.sha256()
-    file = open(file_to_hash, 'rb')
-    while True:
-        contents = file.read(65536)
+    log_info("Fixed dates for " + dest_file_name)
+
+def weak_checksum(block):
+    """Computes the rsync-style weak checksum of a block, returned as (checksum, a, b) so that it can be rolled forward."""
+    a = sum(block) % DELTA_CHECKSUM_MODULUS
+    b = sum(itertools.accumulate(block)) % DELTA_CHECKSUM_MODULUS
+    return (b << 16) | a, a, b
+
+def strong_checksum(block):
+    """Computes the strong checksum used to confirm a weak checksum match."""
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def block_signatures(file_name, block_size):
+    """Computes the weak and strong checksums of every block in the file. Returns a dictionary of weak checksum to a list of (strong checksum, offset, length)."""
+    signatures = {}
+    offset = 0
+    with open(file_name, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            weak, _, _ = weak_checksum(block)
+            signatures.setdefault(weak, []).append((strong_checksum(block), offset, len(block)))
+            offset = offset + len(block)
+    record_bytes_read(offset)
+    return signatures
+
+def find_block(signatures, weak, block):
+    """Returns the offset of the destination block matching the given source block, or None."""
+    candidates = signatures.get(weak)
+    if candidates is None:
+        return None
+    strong = strong_checksum(block)
+    for candidate_strong, candidate_offset, candidate_length in candidates:
+        if candidate_length == len(block) and candidate_strong == strong:
+            return candidate_offset
+    return None
+
+def add_instruction(instructions, instruction):
+    """Appends an (source offset, destination offset or None, length) instruction, merging it with the previous one when contiguous."""
+    if len(instructions) > 0:
+        last_source, last_dest, last_length = instructions[-1]
+        if last_source + last_length == instruction[0]:
+            if last_dest is None and instruction[1] is None:
+                instructions[-1] = (last_source, None, last_length + instruction[2])
+                return
+            if last_dest is not None and instruction[1] is not None and last_dest + last_length == instruction[1]:
+                instructions[-1] = (last_source, last_dest, last_length + instruction[2])
+                return
+    instructions.append(instruction)
+
+def delta_instructions(source_file_name, signatures, block_size):
+    """Scans the source file with a rolling checksum, looking for blocks that already exist in the destination. Returns a list of
+    (source offset, destination offset, length) instructions, where a destination offset of None means the data must come from the source.
+    Returns None if so little of the source matches that a plain copy would be cheaper."""
+    instructions = []
+    unmatched = 0     # Bytes flushed as unmatched data so far
+    buffer = bytearray()
+    buffer_offset = 0 # File offset of buffer[0]
+    pos = 0           # Start of the window, relative to the buffer
+    literal_start = 0 # Start of the unmatched data, relative to the buffer
+    weak = None
+
+    with open(source_file_name, 'rb') as source_file:
+        eof = False
+        while True:
+            # Keep at least one full window plus the next byte in the buffer, discarding data we're done with.
+            if not eof and len(buffer) - pos <= block_size:
+                del buffer[:literal_start]
+                pos = pos - literal_start
+                buffer_offset = buffer_offset + literal_start
+                literal_start = 0
+                contents = source_file.read(block_size * 8)
+                if contents:
+                    record_bytes_read(len(contents))
+                    buffer.extend(contents)
+                else:
+                    eof = True
+            window_end = min(pos + block_size, len(buffer))
+            if window_end <= pos:
+                break
+
+            # Compute the checksum from scratch, or roll it forward by one byte. Only look at the window's contents when the weak checksum matches.
+            if weak is None:
+                weak, a, b = weak_checksum(buffer[pos:window_end])
+            matched_offset = None
+            if weak in signatures:
+                matched_offset = find_block(signatures, weak, bytes(buffer[pos:window_end]))
+
+            if matched_offset is not None:
+                if literal_start < pos:
+                    add_instruction(instructions, (buffer_offset + literal_start, None, pos - literal_start))
+                    unmatched = unmatched + pos - literal_start
+                add_instruction(instructions, (buffer_offset + pos, matched_offset, window_end - pos))
+                pos = window_end
+                literal_start = pos
+                weak = None
+            elif window_end - pos < block_size:
+                # The tail is shorter than a block and didn't match, so the rest is literal.
+                pos = len(buffer)
+                break
+            else:
+                # Flush unmatched data a block at a time so the buffer doesn't grow without bound.
+                if pos - literal_start >= block_size:
+                    add_instruction(instructions, (buffer_offset + literal_start, None, pos - literal_start))
+                    unmatched = unmatched + pos - literal_start
+                    literal_start = pos
+
+                    # The byte by byte scan is slow, so stop once it's clear that there's little to reuse.
+                    scanned = buffer_offset + pos
+                    if scanned >= DELTA_MIN_SCAN_BLOCKS * block_size and unmatched > DELTA_MAX_UNMATCHED_FRACTION * scanned:
+                        return None
+                if window_end >= len(buffer):
+                    pos = window_end
+                    weak = None
+                    continue
+                out_byte = buffer[pos]
+                in_byte = buffer[window_end]
+                a = (a - out_byte + in_byte) % DELTA_CHECKSUM_MODULUS
+                b = (b - block_size * out_byte + a) % DELTA_CHECKSUM_MODULUS
+                weak = (b << 16) | a
+                pos = pos + 1
+
+        if literal_start < len(buffer):
+            add_instruction(instructions, (buffer_offset + literal_start, None, len(buffer) - literal_start))
+    return instructions
+
+def copy_range(source_file, dest_file, source_offset, length):
+    """Copies a range of bytes from one open file to the current position of another."""
+    source_file.seek(source_offset, 0)
+    while length > 0:
+        contents = source_file.read(min(length, 1024 * 1024))
         if not contents:
+            raise IOError("Unexpected end of file")
+        dest_file.write(contents)
+        record_bytes_read(len(contents))
+        record_bytes_written(len(contents))
+        length = length - len(contents)
+
+def temp_file_name_for(dest_file_name):
+    """Returns the name of the temporary file used while replacing the destination file. It's in the same directory so that it can be renamed atomically."""
+    return os.path.join(os.path.dirname(dest_file_name), "." + os.path.basename(dest_file_name) + ".pysync.tmp")
+
+def delta_copy_file(source_file_name, dest_file_name, block_size=DELTA_BLOCK_SIZE):
+    """Updates the destination file so that it matches the source, writing only the blocks that differ. When every unchanged
+    block is still at the same offset the file is patched in place, otherwise a temporary file is assembled and renamed over it.
+    Returns the number of bytes written, or None (without touching the destination) if too little of it could be reused."""
+    signatures = block_signatures(dest_file_name, block_size)
+    instructions = delta_instructions(source_file_name, signatures, block_size)
+    if instructions is None:
+        return None
+    source_size = os.path.getsize(source_file_name)
+    bytes_written = 0
+
+    # In place: only the literal ranges need to be written.
+    if all(dest_offset is None or dest_offset == source_offset for source_offset, dest_offset, _ in instructions):
+        with open(source_file_name, 'rb') as source_file, open(dest_file_name, 'r+b') as dest_file:
+            for source_offset, dest_offset, length in instructions:
+                if dest_offset is None:
+                    dest_file.seek(source_offset, 0)
+                    copy_range(source_file, dest_file, source_offset, length)
+                    bytes_written = bytes_written + length
+            dest_file.truncate(source_size)
+
+    # Blocks have moved, so reading from the destination while writing to it would be unsafe.
+    else:
+        temp_file_name = temp_file_name_for(dest_file_name)
+        try:
+            with open(source_file_name, 'rb') as source_file, open(dest_file_name, 'rb') as old_dest_file, open(temp_file_name, 'wb') as temp_file:
+                for source_offset, dest_offset, length in instructions:
+                    if dest_offset is None:
+                        copy_range(source_file, temp_file, source_offset, length)
+                    else:
+                        copy_range(old_dest_file, temp_file, dest_offset, length)
+                    bytes_written = bytes_written + length
+            os.replace(temp_file_name, dest_file_name)
+        except:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+
+    shutil.copystat(source_file_name, dest_file_name)
+    return bytes_written
+
+def kernel_copy(copy_func, source_fd, dest_fd, offset, size):
+    """Copies from the offset to the end of the file using a kernel copy function that takes (source, dest, offset, count) and
+    returns the number of bytes copied. Returns the new offset, which is unchanged if the method isn't supported."""
+    while offset < size:
+        try:
+            num_copied = copy_func(source_fd, dest_fd, offset, min(COPY_CHUNK_SIZE, size - offset))
+        except OSError as e:
+            if offset == 0 and e.errno in COPY_METHOD_UNSUPPORTED_ERRNOS:
+                return offset
+            raise
+        if num_copied == 0:
             break
-        hash_algorithm.update(contents)
-    hash_str = hash_algorithm.hexdigest()
-    return hash_str
+        record_bytes_read(num_copied)
+        record_bytes_written(num_copied)
+        offset = offset + num_copied
+    return offset
 
-def compare_dir(source_dir, dest_dir, recurse, sync, fix_dates, report_missing_files, no_hash):
-    file_names = os.listdir(source_dir)
-    for file_name in file_names:
-        # Generate the complete path.
-        complete_file_name = os.path.join(source_dir, file_name)
+def engine_copy_file(source_file_name, dest_file_name):
+    """Copies the file's contents using the fastest method the platform and file systems support: a reflink, then
+    copy_file_range, then sendfile, and finally a buffered copy. Metadata is copied the same way shutil.copy2 does it.
+    Returns the name of the method that was used."""
+    with open(source_file_name, 'rb', buffering=0) as source_file, open(dest_file_name, 'wb', buffering=0) as dest_file:
+        source_fd = source_file.fileno()
+        dest_fd = dest_file.fileno()
+        size = os.fstat(source_fd).st_size
+        copy_method = None
 
-        # File:
-        if os.path.isfile(complete_file_name):
+        # Reflink: the destination shares the source's blocks, nothing is actually copied.
+        if fcntl is not None and sys.platform.startswith('linux'):
             try:
-                # Generate the complete paths for the source and destination files.
-                source_file_name = os.path.join(source_dir, file_name)
-                dest_file_name = os.path.join(dest_dir, file_name)
-
-                # Does the destination file even exist?
-                dest_file_exists = os.path.exists(dest_file_name)
-
-                # Are we logging missing files?
-                if report_missing_files and dest_file_exists == False:
-                    print(dest_file_name + " does not exist.")
-
-                # Are we copying files that are missing or do not match?
-                if sync:
-
-                    # Assume we need to copy, try to prove otherwise.
-                    needs_to_copy = True
-
-                    # Don't bother hashing if the destination file is missing.
-                    if dest_file_exists:
-
-                        # If the no-hash flag was passed then do not compare file hashes.
-                        if no_hash == False:
-
-                            # Hash the source and destination files. Since both exist we need to know if they're different.
-                            source_hash_str = hash_file(source_file_name)
-                            dest_hash_str = hash_file(dest_file_name)
-                            needs_to_copy = source_hash_str != dest_hash_str
-                            if needs_to_copy:
-                                print(source_file_name + " does not match " + dest_file_name)
-
-                        # If the destination file exists and we're not hashing, then don't copy.
-                        else:
-                            needs_to_copy = False
-                    
-                    # If the file is missing then print it, even if the report-missing-files flag is False.
-                    # This way the user knows why we're copying file file.
-                    elif report_missing_files == False:
-                        print(dest_file_name + " does not exist.")
-
-                    # Copy the file if the hashes don't match or the destination file doesn't exist.
+                fcntl.ioctl(dest_fd, FICLONE, source_fd)
+                copy_method = COPY_METHOD_REFLINK
+            except OSError as e:
+                if e.errno not in COPY_METHOD_UNSUPPORTED_ERRNOS:
+                    raise
+
+        # In-kernel copies. copy_file_range may also be able to use server side copies on network file systems.
+        offset = 0
+        if copy_method is None and hasattr(os, 'copy_file_range'):
+            offset = kernel_copy(lambda in_fd, out_fd, in_offset, count: os.copy_file_range(in_fd, out_fd, count, in_offset, in_offset), source_fd, dest_fd, offset, size)
+            if offset > 0 or size == 0:
+                copy_method = COPY_METHOD_COPY_FILE_RANGE
+        if copy_method is None and hasattr(os, 'sendfile'):
+            offset = kernel_copy(lambda in_fd, out_fd, in_offset, count: os.sendfile(out_fd, in_fd, in_offset, count), source_fd, dest_fd, offset, size)
+            if offset > 0:
+                copy_method = COPY_METHOD_SENDFILE
+
+        # Buffered copy of whatever is left (everything, if nothing else worked, or anything appended to the source during the copy).
+        if copy_method != COPY_METHOD_REFLINK:
+            if copy_method is None:
+                copy_method = COPY_METHOD_BUFFERED
+            source_file.seek(offset, 0)
+            dest_file.seek(offset, 0)
+            buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+            while True:
+                num_read = source_file.readinto(buffer)
+                if not num_read:
+                    break
+                dest_file.write(buffer[:num_read])
+                record_bytes_read(num_read)
+                record_bytes_written(num_read)
+
+    shutil.copystat(source_file_name, dest_file_name)
+    return copy_method
+
+def pipeline_reader(source_file, buffers, free_queue, full_queue):
+    """Reader stage of the pipelined copy. Fills free buffers from the source file and passes them on, followed by None at the end
+    of the file (or the exception, if the read failed)."""
+    try:
+        while True:
+            index = free_queue.get()
+            if index is None:
+                return
+            num_read = source_file.readinto(buffers[index])
+            if not num_read:
+                full_queue.put(None)
+                return
+            full_queue.put((index, num_read))
+    except Exception as e:
+        full_queue.put(e)
+
+def pipelined_copy_file(source_file_name, dest_file_name, algorithm=None):
+    """Copies the file in a single pass, with a reader thread filling a ring of preallocated buffers while this thread hashes
+    each buffer and writes it to a temporary file. The temporary file is renamed over the destination once it is complete,
+    and metadata is copied the same way shutil.copy2 does it. Returns the hash of the data that was written."""
+    if algorithm is None:
+        algorithm = g_hash_algorithm
+    hash_algorithm = hashing.new_hash(algorithm)
+    buffers = [ memoryview(bytearray(PIPELINE_BUFFER_SIZE)) for _ in range(0, PIPELINE_NUM_BUFFERS) ]
+    free_queue = queue.Queue()
+    full_queue = queue.Queue()
+    for index in range(0, PIPELINE_NUM_BUFFERS):
+        free_queue.put(index)
+
+    temp_file_name = temp_file_name_for(dest_file_name)
+    try:
+        with open(source_file_name, 'rb', buffering=0) as source_file, open(temp_file_name, 'wb', buffering=0) as temp_file:
+            reader = threading.Thread(target=pipeline_reader, args=(source_file, buffers, free_queue, full_queue))
+            reader.start()
+            try:
+                while True:
+                    item = full_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    index, num_read = item
+                    view = buffers[index][:num_read]
+                    hash_algorithm.update(view)
+                    temp_file.write(view)
+                    record_bytes_read(num_read)
+                    record_bytes_written(num_read)
+                    free_queue.put(index)
+            finally:
+                free_queue.put(None)
+                reader.join()
+        shutil.copystat(source_file_name, temp_file_name)
+        os.replace(temp_file_name, dest_file_name)
+    except:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+    return hash_algorithm.hexdigest()
+
+def copy_file(source_file_name, dest_file_name, delta_threshold=None, source_size=None, dest_file_exists=None, hash_copy=False):
+    """Copies the source file to the complete path given by the destination file name. If a delta threshold (in bytes) is given
+    and the destination already exists and is at least that large, only the changed blocks are transferred. If hash_copy is set,
+    the file is copied with a single pass that also hashes it, and the hash is returned; otherwise returns None."""
+    if delta_threshold is not None:
+        if source_size is None:
+            source_size = os.path.getsize(source_file_name)
+        if dest_file_exists is None:
+            dest_file_exists = os.path.isfile(dest_file_name)
+        if dest_file_exists and source_size >= delta_threshold:
+            log_info("Delta copying " + source_file_name + " to " + dest_file_name)
+            bytes_written = delta_copy_file(source_file_name, dest_file_name)
+            if bytes_written is not None:
+                log_info("Delta copying done, wrote " + str(bytes_written) + " of " + str(source_size) + " bytes.")
+                return None
+            log_info("Delta copying abandoned, too little of the destination matches.")
+    log_info("Copying " + source_file_name + " to " + dest_file_name)
+    if hash_copy:
+        hash_str = pipelined_copy_file(source_file_name, dest_file_name)
+        log_info("Copying done (" + COPY_METHOD_PIPELINE + ").")
+        return hash_str
+    copy_method = engine_copy_file(source_file_name, dest_file_name)
+    log_info("Copying done (" + copy_method + ").")
+    return None
+
+class HashCache(object):
+    """Persistent SQLite cache of file hashes. An entry is only valid while the file's size, mtime, inode, and device are unchanged."""
+
+    def __init__(self, db_file_name, max_entries=DEFAULT_HASH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+        self.now = time.time()
+        self.connection = sqlite3.connect(db_file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        # Caches created before hashes were tagged with their algorithm can't be trusted, so start over.
+        columns = [ row[1] for row in self.connection.execute("PRAGMA table_info(hashes)") ]
+        if len(columns) > 0 and "algorithm" not in columns:
+            self.connection.execute("DROP TABLE hashes")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, device INTEGER, hash TEXT, last_seen REAL, PRIMARY KEY (path, algorithm))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS hashes_last_seen ON hashes (last_seen)")
+        self.connection.commit()
+
+    def commit_if_needed(self):
+        """Batches writes so that we're not committing a transaction for every file. Caller must hold the lock."""
+        self.pending_writes = self.pending_writes + 1
+        if self.pending_writes >= HASH_CACHE_COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def lookup(self, file_name, file_stat, algorithm):
+        """Returns the file's cached hash for the given algorithm, or None if there isn't one or the file has changed since it was cached."""
+        key = os.path.abspath(file_name)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, device, hash FROM hashes WHERE path = ? AND algorithm = ?", (key, algorithm)).fetchone()
+            if row is None:
+                return None
+            if row[0:4] != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev):
+                self.connection.execute("DELETE FROM hashes WHERE path = ?", (key,))
+                self.commit_if_needed()
+                return None
+            self.connection.execute("UPDATE hashes SET last_seen = ? WHERE path = ? AND algorithm = ?", (self.now, key, algorithm))
+            self.commit_if_needed()
+            return row[4]
+
+    def store(self, file_name, file_stat, algorithm, hash_str):
+        """Records the hash for the file, unless the file was modified too recently for its stat signature to be trusted."""
+        if self.now - (file_stat.st_mtime_ns / 1e9) < HASH_CACHE_RACY_SECONDS:
+            return
+        key = os.path.abspath(file_name)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO hashes (path, algorithm, size, mtime_ns, inode, device, hash, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, algorithm, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_dev, hash_str, self.now))
+            self.commit_if_needed()
+
+    def prune(self):
+        """Removes stale entries, then the least recently seen entries until the cache is within its size limit."""
+        with self.lock:
+            stale_time = self.now - (HASH_CACHE_STALE_DAYS * 24 * 60 * 60)
+            self.connection.execute("DELETE FROM hashes WHERE last_seen < ?", (stale_time,))
+            num_entries = self.connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+            if num_entries > self.max_entries:
+                self.connection.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_seen ASC LIMIT ?)", (num_entries - self.max_entries,))
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def flush(self):
+        """Writes any pending changes to disk."""
+        with self.lock:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        """Prunes the cache and writes everything to disk."""
+        self.prune()
+        with self.lock:
+            self.connection.close()
+
+def hash_file(file_to_hash, hash_cache=None, file_stat=None, algorithm=None):
+    """Computes a hash of the specified file, using the hash cache (if provided) to avoid re-reading unchanged files. Uses the
+    algorithm selected for this run unless another one is given."""
+    if algorithm is None:
+        algorithm = g_hash_algorithm
+    if hash_cache is not None:
+        if file_stat is None:
+            file_stat = os.stat(file_to_hash)
+        hash_str = hash_cache.lookup(file_to_hash, file_stat, algorithm)
+        if hash_str is not None:
+            return hash_str
+
+    log_info("Hashing " + file_to_hash + "...")
+    hash_str = hashing.hash_file(file_to_hash, algorithm, g_hash_buffer_size, record_bytes_read)
+
+    if hash_cache is not None:
+        hash_cache.store(file_to_hash, file_stat, algorithm, hash_str)
+    return hash_str
+
+class Manifest(object):
+    """Record of the size, modification time, and hash of every file that was verified or copied to the destination. Lets later
+    runs compare source hashes against the manifest instead of re-reading the destination files. Stored as JSON lines, with a
+    header line first, at the root of the destination directory. All of the hashes in a manifest use the same algorithm."""
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.file_name = os.path.join(dest_dir, MANIFEST_FILE_NAME)
+        self.algorithm = g_hash_algorithm
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def relative_path(self, file_name):
+        """Converts a destination file name to the key used in the manifest."""
+        return os.path.relpath(file_name, self.dest_dir)
+
+    def load(self):
+        """Reads the manifest from disk. A missing or unreadable manifest is treated as empty."""
+        if not os.path.isfile(self.file_name):
+            return
+        try:
+            with open(self.file_name, 'rt', encoding='utf-8') as manifest_file:
+                header = json.loads(manifest_file.readline())
+                if header.get("version") != MANIFEST_VERSION:
+                    log_info("Ignoring manifest " + self.file_name + " with unsupported version.")
+                    return
+                self.algorithm = header.get("algorithm", hashing.HASH_ALGORITHM_SHA256)
+                for line in manifest_file:
+                    entry = json.loads(line)
+                    self.entries[entry["path"]] = (entry["size"], entry["mtime_ns"], entry["hash"])
+        except:
+            log_error("[ERROR] Exception when reading the manifest " + self.file_name)
+            log_error(traceback.format_exc())
+            self.entries = {}
+
+    def save(self):
+        """Writes the manifest to a temporary file and then renames it over the old one, so that an interrupted write can't corrupt it."""
+        temp_file_name = self.file_name + ".tmp"
+        with self.lock:
+            with open(temp_file_name, 'wt', encoding='utf-8') as manifest_file:
+                manifest_file.write(json.dumps({ "version": MANIFEST_VERSION, "algorithm": self.algorithm }) + "\n")
+                for path in sorted(self.entries.keys()):
+                    size, mtime_ns, hash_str = self.entries[path]
+                    manifest_file.write(json.dumps({ "path": path, "size": size, "mtime_ns": mtime_ns, "hash": hash_str }) + "\n")
+            os.replace(temp_file_name, self.file_name)
+
+    def lookup(self, file_name, file_stat, algorithm):
+        """Returns the recorded hash for the destination file, or None if there isn't one, it was made with a different algorithm,
+        or the file has changed since it was recorded."""
+        with self.lock:
+            if algorithm != self.algorithm:
+                return None
+            entry = self.entries.get(self.relative_path(file_name))
+        if entry is None or entry[0:2] != (file_stat.st_size, file_stat.st_mtime_ns):
+            return None
+        return entry[2]
+
+    def store(self, file_name, file_stat, algorithm, hash_str):
+        """Records the hash of a destination file that has just been verified or copied. Storing a hash made with a different
+        algorithm discards all of the existing entries, rather than mixing algorithms."""
+        with self.lock:
+            if algorithm != self.algorithm:
+                log_info("Discarding " + self.algorithm + " manifest entries, now using " + algorithm + ".")
+                self.algorithm = algorithm
+                self.entries = {}
+            self.entries[self.relative_path(file_name)] = (file_stat.st_size, file_stat.st_mtime_ns, hash_str)
+
+    def remove(self, path):
+        """Removes an entry, given its key."""
+        with self.lock:
+            self.entries.pop(path, None)
+
+def verify_manifest_entry(manifest, path, entry):
+    """Hashes the destination file described by a manifest entry. Returns a description of the problem, or None if the file matches."""
+    file_name = os.path.join(manifest.dest_dir, path)
+    try:
+        if not os.path.isfile(file_name):
+            return "does not exist"
+        if hash_file(file_name, algorithm=manifest.algorithm) != entry[2]:
+            return "does not match the manifest"
+    except:
+        log_error("[ERROR] Exception when verifying " + file_name)
+        log_error(traceback.format_exc())
+        return "could not be read"
+    return None
+
+def verify_manifest(manifest, jobs=1):
+    """Audits every manifest entry against the actual contents of the destination file, dropping entries that are wrong so that
+    the next sync will re-check (and if necessary re-copy) those files."""
+    with manifest.lock:
+        entries = sorted(manifest.entries.items())
+    log_info("Verifying " + str(len(entries)) + " manifest entries...")
+    num_bad = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = executor.map(lambda item: run_buffered_result(verify_manifest_entry, manifest, item[0], item[1]), entries)
+        for (path, _), (buffer, problem) in zip(entries, results):
+            print_buffered(buffer)
+            if problem is not None:
+                log_info(os.path.join(manifest.dest_dir, path) + " " + problem + ".")
+                manifest.remove(path)
+                num_bad = num_bad + 1
+    log_info("Manifest verification done, " + str(num_bad) + " of " + str(len(entries)) + " entries were bad.")
+
+def sample_hash_file(file_to_hash, file_size):
+    """Computes a hash of blocks sampled from the head, middle, and tail of the specified file."""
+    hash_algorithm = hashing.new_hash(g_hash_algorithm)
+    offsets = sorted(set([0, max(0, (file_size // 2) - (SAMPLE_BLOCK_SIZE // 2)), max(0, file_size - SAMPLE_BLOCK_SIZE)]))
+    with open(file_to_hash, 'rb') as file:
+        for offset in offsets:
+            file.seek(offset, 0)
+            contents = file.read(SAMPLE_BLOCK_SIZE)
+            record_bytes_read(len(contents))
+            hash_algorithm.update(contents)
+    return hash_algorithm.hexdigest()
+
+def tiered_compare(source_file_name, dest_file_name, strict, hash_cache=None, source_stat=None, dest_stat=None):
+    """Compares two files using progressively more expensive checks: size and modification time, then sampled blocks, then
+    (if strict) a hash of the entire file. Returns a description of the difference, or None if the files are considered equal."""
+    if source_stat is None:
+        source_stat = os.stat(source_file_name)
+    if dest_stat is None:
+        dest_stat = os.stat(dest_file_name)
+
+    # Tier 1: Metadata. Different sizes can't possibly have the same contents.
+    if source_stat.st_size != dest_stat.st_size:
+        return "size differs"
+    same_mtime = abs(source_stat.st_mtime_ns - dest_stat.st_mtime_ns) <= MTIME_TOLERANCE_NS
+    if same_mtime and not strict:
+        return None
+
+    # Tier 2: Sampled blocks.
+    if sample_hash_file(source_file_name, source_stat.st_size) != sample_hash_file(dest_file_name, dest_stat.st_size):
+        return "sampled blocks differ"
+    if not strict:
+        return None
+
+    # Tier 3: Full hash. Only small files are completely covered by the samples.
+    if source_stat.st_size > 3 * SAMPLE_BLOCK_SIZE:
+        if hash_file(source_file_name, hash_cache, source_stat) != hash_file(dest_file_name, hash_cache, dest_stat):
+            return "hashes differ"
+    return None
+
+def read_fully(file, view):
+    """Reads into the buffer until it is full or the end of the file is reached. Returns the number of bytes read."""
+    total = 0
+    while total < len(view):
+        num_read = file.readinto(view[total:])
+        if not num_read:
+            break
+        total = total + num_read
+    return total
+
+def bytes_compare(source_file_name, dest_file_name, source_stat=None, dest_stat=None):
+    """Compares two files by reading them in lockstep, stopping at the first chunk that differs. Returns a description
+    of the difference, or None if the files are identical."""
+    if source_stat is None:
+        source_stat = os.stat(source_file_name)
+    if dest_stat is None:
+        dest_stat = os.stat(dest_file_name)
+
+    # Different sizes can't possibly have the same contents, so don't read anything.
+    if source_stat.st_size != dest_stat.st_size:
+        return "size differs"
+
+    buffers = getattr(g_compare_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = (memoryview(bytearray(COMPARE_BUFFER_SIZE)), memoryview(bytearray(COMPARE_BUFFER_SIZE)))
+        g_compare_buffers.buffers = buffers
+    source_view, dest_view = buffers
+
+    with open(source_file_name, 'rb', buffering=0) as source_file, open(dest_file_name, 'rb', buffering=0) as dest_file:
+        offset = 0
+        while True:
+            source_len = read_fully(source_file, source_view)
+            dest_len = read_fully(dest_file, dest_view)
+            record_bytes_read(source_len + dest_len)
+            if source_len != dest_len or source_view[:source_len] != dest_view[:dest_len]:
+                return "contents differ near offset " + str(offset)
+            if source_len == 0:
+                return None
+            offset = offset + source_len
+
+def entry_size(entry):
+    """Returns the size of the file for the stats. A file that has disappeared is logged and counted as empty, rather than
+    stopping the sync."""
+    try:
+        return entry.stat().st_size
+    except OSError as e:
+        log_error("[ERROR] Cannot stat " + entry.path + ": " + str(e))
+        return 0
+
+def compare_file(source_entry, dest_file_name, dest_entry, sync, fix_dates, report_missing_files, no_hash, hash_cache=None, compare_mode=COMPARE_HASH, strict=False, delta_threshold=None, manifest=None):
+    """Compares a single source file against its destination counterpart, copying and fixing dates as requested. The source
+    and destination are given as directory entries (dest_entry is None if the destination is missing) so that their stat
+    results are only fetched once, and only if needed. If a manifest is given, and files are being compared by hash, the
+    destination's hash is taken from the manifest when possible and the manifest is updated afterwards."""
+    source_file_name = source_entry.path
+    use_manifest = manifest is not None and no_hash == False and compare_mode == COMPARE_HASH
+    source_hash_str = None
+    needs_to_copy = False
+    start_time = time.time()
+    try:
+        # Does the destination file even exist?
+        dest_file_exists = dest_entry is not None
+
+        # Are we logging missing files?
+        if report_missing_files and dest_file_exists == False:
+            log_info(dest_file_name + " does not exist.")
+
+        # Are we copying files that are missing or do not match?
+        if sync:
+
+            # Assume we need to copy, try to prove otherwise.
+            needs_to_copy = True
+
+            # Don't bother hashing if the destination file is missing.
+            if dest_file_exists:
+
+                # If the no-hash flag was passed then do not compare file hashes.
+                if no_hash == False and compare_mode == COMPARE_TIERED:
+
+                    # Only read as much of the files as is needed to tell them apart.
+                    with io_phase(PHASE_COMPARE, source_entry.stat().st_dev, dest_entry.stat().st_dev):
+                        difference = tiered_compare(source_file_name, dest_file_name, strict, hash_cache, source_entry.stat(), dest_entry.stat())
+                    needs_to_copy = difference is not None
+                    if needs_to_copy:
+                        log_info(source_file_name + " does not match " + dest_file_name + " (" + difference + ")")
+
+                elif no_hash == False and compare_mode == COMPARE_BYTES:
+
+                    # Read both files side by side, stopping as soon as they differ.
+                    with io_phase(PHASE_COMPARE, source_entry.stat().st_dev, dest_entry.stat().st_dev):
+                        difference = bytes_compare(source_file_name, dest_file_name, source_entry.stat(), dest_entry.stat())
+                    needs_to_copy = difference is not None
+                    if needs_to_copy:
+                        log_info(source_file_name + " does not match " + dest_file_name + " (" + difference + ")")
+
+                elif no_hash == False and source_entry.stat().st_size != dest_entry.stat().st_size:
+
+                    # Files of different sizes can't have the same hash, so don't read either of them. If the source's
+                    # hash is needed it will be computed as it is copied.
+                    log_info(source_file_name + " does not match " + dest_file_name + " (size differs)")
+
+                elif no_hash == False:
+
+                    # Hash the source and destination files. Since both exist we need to know if they're different.
+                    # The destination doesn't need to be read if the manifest already knows its hash.
+                    with io_phase(PHASE_HASH_SOURCE, source_entry.stat().st_dev):
+                        source_hash_str = hash_file(source_file_name, hash_cache, source_entry.stat())
+                    with io_phase(PHASE_HASH_DEST, dest_entry.stat().st_dev):
+                        dest_hash_str = None
+                        if use_manifest:
+                            dest_hash_str = manifest.lookup(dest_file_name, dest_entry.stat(), g_hash_algorithm)
+                        if dest_hash_str is None:
+                            dest_hash_str = hash_file(dest_file_name, hash_cache, dest_entry.stat())
+                    needs_to_copy = source_hash_str != dest_hash_str
                     if needs_to_copy:
-                        copy_file(source_file_name, dest_file_name)
+                        log_info(source_file_name + " does not match " + dest_file_name)
+
+                # If the destination file exists and we're not hashing, then don't copy.
+                else:
+                    needs_to_copy = False
+
+            # If the file is missing then print it, even if the report-missing-files flag is False.
+            # This way the user knows why we're copying file file.
+            elif report_missing_files == False:
+                log_info(dest_file_name + " does not exist.")
+
+            # Copy the file if the hashes don't match or the destination file doesn't exist. When the hash of the copied data
+            # will be recorded, hash it as it's copied rather than reading the source again.
+            if needs_to_copy:
+                hash_copy = no_hash == False and compare_mode == COMPARE_HASH and (use_manifest or hash_cache is not None)
+                with io_phase(PHASE_COPY, source_entry.stat().st_dev, dest_device(dest_file_name, dest_entry)):
+                    copied_hash_str = copy_file(source_file_name, dest_file_name, delta_threshold, source_entry.stat().st_size, dest_file_exists, hash_copy)
+                if copied_hash_str is not None:
+                    if source_hash_str is not None and copied_hash_str != source_hash_str:
+                        log_error("[ERROR] " + source_file_name + " changed while it was being copied")
+                    elif source_hash_str is None and hash_cache is not None:
+                        hash_cache.store(source_file_name, source_entry.stat(), g_hash_algorithm, copied_hash_str)
+                    if hash_cache is not None:
+                        hash_cache.store(dest_file_name, os.stat(dest_file_name), g_hash_algorithm, copied_hash_str)
+                    source_hash_str = copied_hash_str
+
+        # Are we fixing the file dates?
+        if fix_dates:
+            with timed_phase(PHASE_FIX_DATES):
+                fix_file_dates(source_file_name, dest_file_name)
+
+        # Record what's now at the destination.
+        if use_manifest and sync:
+            if source_hash_str is None:
+                with io_phase(PHASE_HASH_SOURCE, source_entry.stat().st_dev):
+                    source_hash_str = hash_file(source_file_name, hash_cache, source_entry.stat())
+            if needs_to_copy or fix_dates:
+                manifest.store(dest_file_name, os.stat(dest_file_name), g_hash_algorithm, source_hash_str)
+            else:
+                manifest.store(dest_file_name, dest_entry.stat(), g_hash_algorithm, source_hash_str)
+    except:
+        log_error("[ERROR] Exception when comparing " + source_file_name + " to " + dest_file_name)
+        log_error(traceback.format_exc())
+        log_error(sys.exc_info()[0])
 
-                # Are we fixing the file dates?
-                if fix_dates:
-                    fix_file_dates(source_file_name, dest_file_name)
-            except:
-                log_error("[ERROR] Exception when comparing " + source_file_name + " to " + dest_file_name)
-                log_error(traceback.format_exc())
-                log_error(sys.exc_info()[0])
+    if g_stats is not None:
+        g_stats.file_done(source_file_name, entry_size(source_entry), time.time() - start_time, needs_to_copy)
+
+class FileEntry(object):
+    """Stand-in for os.DirEntry, for files that were found some way other than scanning their directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.file_stat = None
+
+    def stat(self):
+        if self.file_stat is None:
+            self.file_stat = os.stat(self.path)
+        return self.file_stat
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+def scan_dest_dir(dest_dir):
+    """Lists the destination directory once, returning a dictionary of file name to directory entry. A missing directory is
+    treated as empty, as is one that can't be read (which is logged, and leaves the copies into it to fail file by file)."""
+    try:
+        with os.scandir(dest_dir) as entries:
+            return { entry.name: entry for entry in entries }
+    except FileNotFoundError:
+        return {}
+    except OSError as e:
+        log_error("[ERROR] Cannot list " + dest_dir + ": " + str(e))
+        return {}
+
+def scan_source_dir(source_dir):
+    """Lists the source directory. The listing is read in full so that its directory handle is closed straight away. Returns
+    None, after logging the error, if it can't be read."""
+    try:
+        with os.scandir(source_dir) as entries:
+            return list(entries)
+    except OSError as e:
+        log_error("[ERROR] Cannot list " + source_dir + ": " + str(e))
+        return None
+
+def walk_dir(source_dir, dest_dir, recurse):
+    """Generator that yields (source entry, destination file, destination entry) for every file under the source directory. Each
+    destination directory is listed once, so existence checks don't cost a syscall per file, and the walk keeps an explicit stack
+    rather than recursing so that deep trees can't hit the interpreter's recursion limit. Each directory is listed in full
+    before moving on, so deep trees don't run out of file descriptors either."""
+    source_entries = scan_source_dir(source_dir)
+    if source_entries is None:
+        return
+    stack = [(iter(source_entries), dest_dir, scan_dest_dir(dest_dir))]
+    while len(stack) > 0:
+        source_entries, dest_dir, dest_entries = stack[-1]
+        source_entry = next(source_entries, None)
+
+        # Done with this directory.
+        if source_entry is None:
+            stack.pop()
+            continue
+
+        # File:
+        if source_entry.is_file():
+            yield source_entry, os.path.join(dest_dir, source_entry.name), dest_entries.get(source_entry.name)
 
         # Dir:
-        elif recurse and os.path.isdir(complete_file_name):
-            # Generate the complete paths for the source and destination subdirs.
-            source_dir_name = os.path.join(source_dir, file_name)
-            dest_dir_name = os.path.join(dest_dir, file_name)
+        elif recurse and source_entry.is_dir():
+            # Directories that can't be read are skipped, rather than ending the whole sync.
+            child_entries = scan_source_dir(source_entry.path)
+            if child_entries is not None:
+                dest_dir_name = os.path.join(dest_dir, source_entry.name)
+                stack.append((iter(child_entries), dest_dir_name, scan_dest_dir(dest_dir_name)))
+
+def timed_walk(work_items):
+    """Wraps the directory walk so that the time spent walking, and the files found, are counted in the stats."""
+    while True:
+        with timed_phase(PHASE_WALK):
+            work_item = next(work_items, None)
+            if work_item is not None:
+                g_stats.file_walked(entry_size(work_item[0]))
+        if work_item is None:
+            g_stats.walk_done = True
+            return
+        yield work_item
+
+def compare_work_items(work_items, sync, fix_dates, report_missing_files, no_hash, hash_cache=None, jobs=1, compare_mode=COMPARE_HASH, strict=False, delta_threshold=None, manifest=None):
+    """Runs compare_file on each (source entry, destination file, destination entry) work item. With more than one job, the
+    hashing and copying is handed off to a pool of worker threads while this thread prints the results in order."""
+
+    # Serial mode.
+    if jobs <= 1:
+        for source_entry, dest_file_name, dest_entry in work_items:
+            compare_file(source_entry, dest_file_name, dest_entry, sync, fix_dates, report_missing_files, no_hash, hash_cache, compare_mode, strict, delta_threshold, manifest)
+        return
+
+    # Parallel mode. Limit the number of outstanding work items so the walk can't get too far ahead of the workers,
+    # and print each item's output in the order the walk produced it so the log is the same from run to run.
+    max_pending = jobs * WORK_QUEUE_ITEMS_PER_JOB
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for source_entry, dest_file_name, dest_entry in work_items:
+            pending.append(executor.submit(run_buffered, compare_file, source_entry, dest_file_name, dest_entry, sync, fix_dates, report_missing_files, no_hash, hash_cache, compare_mode, strict, delta_threshold, manifest))
+            while len(pending) >= max_pending:
+                print_buffered(pending.popleft().result())
+        while len(pending) > 0:
+            print_buffered(pending.popleft().result())
 
-            # Recurse.
-            compare_dir(source_dir_name, dest_dir_name, recurse, sync, fix_dates, report_missing_files, no_hash)
+def compare_dir(source_dir, dest_dir, recurse, sync, fix_dates, report_missing_files, no_hash, hash_cache=None, jobs=1, compare_mode=COMPARE_HASH, strict=False, delta_threshold=None, manifest=None):
+    """Compares every file in the source directory against the destination directory."""
+    work_items = walk_dir(source_dir, dest_dir, recurse)
+    if g_stats is not None:
+        work_items = timed_walk(work_items)
+    compare_work_items(work_items, sync, fix_dates, report_missing_files, no_hash, hash_cache, jobs, compare_mode, strict, delta_threshold, manifest)
+
+class InotifyWatcher(object):
+    """Watches a directory tree for changes using the Linux inotify API, called through ctypes."""
+
+    def __init__(self, root_dir, recurse):
+        self.recurse = recurse
+        self.watches = {}
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.add_tree(root_dir)
+
+    def add_watch(self, dir_name):
+        """Starts watching a single directory."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_name), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            log_error("[ERROR] Unable to watch " + dir_name + ": " + os.strerror(e))
+            if e == errno.ENOSPC:
+                log_info("Out of inotify watches, consider raising fs.inotify.max_user_watches.")
+            return
+        self.watches[wd] = dir_name
+
+    def add_tree(self, dir_name):
+        """Starts watching a directory and (if recursing) all of its subdirectories."""
+        self.add_watch(dir_name)
+        if self.recurse:
+            for root, dir_names, _ in os.walk(dir_name):
+                for sub_dir_name in dir_names:
+                    self.add_watch(os.path.join(root, sub_dir_name))
+
+    def read_events(self, timeout):
+        """Waits up to the timeout (or forever, if None) for events. Returns a list of (path, mask) tuples, which is empty if the timeout expired.
+        A queue overflow is returned with a path of None."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        data = os.read(self.fd, INOTIFY_READ_SIZE)
+        events = []
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset = offset + INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset = offset + name_len
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                events.append((os.path.join(self.watches[wd], name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def watch_dir(source_dir, dest_dir, recurse, sync, fix_dates, report_missing_files, no_hash, hash_cache=None, jobs=1, compare_mode=COMPARE_HASH, strict=False, delta_threshold=None, manifest=None, debounce=DEFAULT_WATCH_DEBOUNCE_SECONDS):
+    """Does a full compare_dir pass and then syncs changes as they happen, using inotify. Bursts of changes are coalesced, and
+    if the kernel's event queue overflows the whole tree is rescanned. Runs until interrupted."""
+    compare_args = (sync, fix_dates, report_missing_files, no_hash, hash_cache, jobs, compare_mode, strict, delta_threshold, manifest)
+
+    # Start watching before the initial pass so that nothing changed during the pass is missed.
+    watcher = InotifyWatcher(source_dir, recurse)
+    try:
+        compare_dir(source_dir, dest_dir, recurse, *compare_args)
+        if manifest is not None:
+            manifest.save()
+        log_info("Watching " + source_dir + " for changes...")
+
+        while True:
+            # Wait for something to happen, then keep collecting events until things have been quiet for the
+            # debounce interval (or the maximum delay has passed).
+            changed_paths = set()
+            rescan = False
+            events = watcher.read_events(None)
+            deadline = time.time() + (debounce * WATCH_MAX_DELAY_MULTIPLIER)
+            while len(events) > 0:
+                for path, mask in events:
+                    if path is None:
+                        rescan = True
+                    elif mask & IN_ISDIR:
+                        if recurse and mask & (IN_CREATE | IN_MOVED_TO):
+                            watcher.add_tree(path)
+                            changed_paths.add(path)
+                    else:
+                        changed_paths.add(path)
+                events = watcher.read_events(max(0.0, min(debounce, deadline - time.time())))
+
+            # The cache's notion of now decides which hashes are too fresh to trust, so it has to move forward with each pass.
+            if hash_cache is not None:
+                hash_cache.now = time.time()
+
+            # The queue overflowed, so we don't know what changed.
+            if rescan:
+                log_info("Event queue overflowed, rescanning " + source_dir + "...")
+                watcher.add_tree(source_dir)
+                compare_dir(source_dir, dest_dir, recurse, *compare_args)
+
+            # Sync just the files that changed. New directories are synced in their entirety.
+            else:
+                work_items = []
+                synced_dirs = []
+                for path in sorted(changed_paths):
+                    if any(path.startswith(synced_dir + os.sep) for synced_dir in synced_dirs):
+                        continue
+                    dest_path = os.path.join(dest_dir, os.path.relpath(path, source_dir))
+                    if os.path.isdir(path):
+                        compare_work_items(work_items, *compare_args)
+                        work_items = []
+                        compare_dir(path, dest_path, recurse, *compare_args)
+                        synced_dirs.append(path)
+                    elif os.path.isfile(path):
+                        dest_entry = None
+                        if os.path.exists(dest_path):
+                            dest_entry = FileEntry(dest_path)
+                        work_items.append((FileEntry(path), dest_path, dest_entry))
+                compare_work_items(work_items, *compare_args)
+
+            if manifest is not None:
+                manifest.save()
+            if hash_cache is not None:
+                hash_cache.flush()
+    finally:
+        watcher.close()
 
 def main():
+    global g_stats
+    global g_io_controller
+    global g_hash_algorithm
+    global g_hash_buffer_size
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--source-dir", type=str, action="store", default=".", help="Directory from which which files are read", required=True)
     parser.add_argument("--dest-dir", type=str, action="store", default=".", help="Directory to write", required=True)
@@ -142,6 +1488,23 @@ def main():
     parser.add_argument("--fix-dates", action="store_true", default=False, help="Sets the destination files creation and modification dates", required=False)
     parser.add_argument("--report-missing-files", action="store_true", default=False, help="Print missing files to stdout; use without --sync if you just want a report of missing files", required=False)
     parser.add_argument("--no-hash", action="store_true", default=False, help="Prevents file hashing, only missing files will be synchronized", required=False)
+    parser.add_argument("--hash-cache", type=str, action="store", default=None, help="SQLite file in which to cache file hashes between runs; files are only re-hashed when their size, mtime, or inode changes", required=False)
+    parser.add_argument("--hash-cache-max-entries", type=int, action="store", default=DEFAULT_HASH_CACHE_MAX_ENTRIES, help="Maximum number of entries to keep in the hash cache", required=False)
+    parser.add_argument("--compare", type=str, action="store", default=COMPARE_HASH, choices=COMPARE_MODES, help="How to compare files that exist on both sides: a full hash, tiered checks (size and date, then sampled blocks), or a direct byte for byte comparison that stops at the first difference", required=False)
+    parser.add_argument("--strict", action="store_true", default=False, help="With --compare tiered, fall back to a full hash when the cheaper checks find no difference", required=False)
+    parser.add_argument("--delta", action="store_true", default=False, help="Transfer only the changed blocks of large files that already exist at the destination", required=False)
+    parser.add_argument("--delta-threshold", type=int, action="store", default=DEFAULT_DELTA_THRESHOLD_MB, help="Minimum file size, in MB, for which --delta is used", required=False)
+    parser.add_argument("--manifest", action="store_true", default=False, help="Keep a manifest of destination file hashes at the root of the destination directory, so destination files aren't re-read on later runs", required=False)
+    parser.add_argument("--verify-manifest", action="store_true", default=False, help="Check every manifest entry against the actual destination file contents before syncing", required=False)
+    parser.add_argument("--stats-file", type=str, action="store", default=None, help="Write a JSON report of phase timings and throughput to this file at the end of the run ('-' for stdout)", required=False)
+    parser.add_argument("--progress", type=float, action="store", default=None, help="Print a progress line, with throughput and ETA, every this many seconds", required=False)
+    parser.add_argument("--watch", action="store_true", default=False, help="After the initial sync, keep running and sync files as they change (Linux only)", required=False)
+    parser.add_argument("--watch-debounce", type=float, action="store", default=DEFAULT_WATCH_DEBOUNCE_SECONDS, help="With --watch, how long the source must be quiet, in seconds, before changes are synced", required=False)
+    parser.add_argument("--hash-algo", type=str, action="store", default=hashing.DEFAULT_HASH_ALGORITHM, choices=hashing.available_algorithms(), help="Hash algorithm used to compare files", required=False)
+    parser.add_argument("--hash-buffer-size", type=int, action="store", default=hashing.DEFAULT_BUFFER_SIZE // 1024, help="Size, in KB, of the buffer used when reading files to hash them", required=False)
+    parser.add_argument("--jobs", type=int, action="store", default=1, help="Number of files to hash and copy concurrently", required=False)
+    parser.add_argument("--adaptive-io", action="store_true", default=False, help="Tune the number of concurrent operations on each device, up to --jobs, based on measured throughput", required=False)
+    parser.add_argument("--max-mbps", type=float, action="store", default=None, help="Limit total disk throughput (reads plus writes) to this many MB/s", required=False)
 
     try:
         args = parser.parse_args()
@@ -149,11 +1512,72 @@ def main():
         parser.error(e)
         sys.exit(1)
 
+    if args.watch and not sys.platform.startswith('linux'):
+        print("--watch requires Linux.")
+        sys.exit(1)
+
+    # When running as a daemon, treat SIGTERM like Ctrl-C so that the manifest, cache, and stats still get written.
+    if args.watch:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     # Configure the error logger.
     logging.basicConfig(filename='error.log', filemode='w', level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
+    # Select the hash algorithm.
+    g_hash_algorithm = args.hash_algo
+    g_hash_buffer_size = args.hash_buffer_size * 1024
+
+    # Open the hash cache, if one was requested.
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache, args.hash_cache_max_entries)
+
+    # Only use delta transfers if they were requested.
+    delta_threshold = None
+    if args.delta:
+        delta_threshold = args.delta_threshold * 1024 * 1024
+
+    # Load the destination manifest, if one was requested.
+    manifest = None
+    if args.manifest or args.verify_manifest:
+        manifest = Manifest(args.dest_dir)
+
+    # Limit concurrency per device, and total bandwidth, if requested.
+    if args.adaptive_io or args.max_mbps is not None:
+        g_io_controller = IOController(max(1, args.jobs), args.adaptive_io, args.max_mbps)
+
+    # Collect statistics, if requested.
+    progress_thread = None
+    if args.stats_file is not None or args.progress is not None:
+        g_stats = SyncStats()
+    if args.progress is not None:
+        progress_thread = ProgressThread(g_stats, args.progress)
+        progress_thread.start()
+
     # Do stuff.
-    compare_dir(args.source_dir, args.dest_dir, args.recurse, args.sync, args.fix_dates, args.report_missing_files, args.no_hash)
+    try:
+        if args.verify_manifest:
+            verify_manifest(manifest, args.jobs)
+        if args.watch:
+            watch_dir(args.source_dir, args.dest_dir, args.recurse, args.sync, args.fix_dates, args.report_missing_files, args.no_hash, hash_cache, args.jobs, args.compare, args.strict, delta_threshold, manifest, args.watch_debounce)
+        else:
+            compare_dir(args.source_dir, args.dest_dir, args.recurse, args.sync, args.fix_dates, args.report_missing_files, args.no_hash, hash_cache, args.jobs, args.compare, args.strict, delta_threshold, manifest)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if progress_thread is not None:
+            progress_thread.stop()
+        if g_io_controller is not None and args.adaptive_io:
+            for line in g_io_controller.summary():
+                print(line)
+        if g_stats is not None:
+            g_stats.finish()
+            if args.stats_file is not None:
+                g_stats.write_report(args.stats_file)
+        if hash_cache is not None:
+            hash_cache.close()
 
 if __name__ == "__main__":
     main()
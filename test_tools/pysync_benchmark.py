@@ -0,0 +1,286 @@
+#! /usr/bin/env python
+
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pysync
+
+# Shape of the synthetic tree, at a scale of 1.0.
+NUM_TINY_FILES = 2000
+NUM_TINY_DIRS = 20
+TINY_FILE_SIZE = 1024
+NUM_HUGE_FILES = 2
+HUGE_FILE_SIZE = 64 * 1024 * 1024
+DEEP_NESTING_LEVELS = 64
+DEEP_FILE_SIZE = 16 * 1024
+
+# Changes made for the partial resync scenario.
+CHANGE_FRACTION = 0.01
+CHANGE_SIZE = 4096
+
+SCENARIO_FIRST_SYNC = "first-sync"
+SCENARIO_NO_OP_RESYNC = "no-op-resync"
+SCENARIO_CHANGED_RESYNC = "1%-change-resync"
+
+class ErrorCounter(logging.Handler):
+    """Counts the errors pysync logs during a scenario."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count = self.count + 1
+
+def write_random_file(file_name, size, rng):
+    """Writes a file of the given size, filled with reproducible random data."""
+    with open(file_name, 'wb') as out_file:
+        remaining = size
+        while remaining > 0:
+            chunk_size = min(remaining, 1024 * 1024)
+            out_file.write(rng.randbytes(chunk_size))
+            remaining = remaining - chunk_size
+
+def generate_tree(root_dir, seed, scale):
+    """Generates the synthetic source tree: many tiny files, a few huge files, and a deeply nested chain of directories.
+    The same seed and scale always produce the same tree. Returns the list of files that were created."""
+    rng = random.Random(seed)
+    file_names = []
+
+    # Many tiny files, spread across a handful of directories.
+    num_tiny_files = max(1, int(NUM_TINY_FILES * scale))
+    for i in range(0, num_tiny_files):
+        dir_name = os.path.join(root_dir, "tiny", "dir" + str(i % NUM_TINY_DIRS))
+        os.makedirs(dir_name, exist_ok=True)
+        file_name = os.path.join(dir_name, "file" + str(i))
+        write_random_file(file_name, TINY_FILE_SIZE, rng)
+        file_names.append(file_name)
+
+    # A few huge files.
+    huge_dir = os.path.join(root_dir, "huge")
+    os.makedirs(huge_dir, exist_ok=True)
+    for i in range(0, NUM_HUGE_FILES):
+        file_name = os.path.join(huge_dir, "file" + str(i))
+        write_random_file(file_name, max(1, int(HUGE_FILE_SIZE * scale)), rng)
+        file_names.append(file_name)
+
+    # Deep nesting, one file per level.
+    dir_name = os.path.join(root_dir, "deep")
+    for i in range(0, DEEP_NESTING_LEVELS):
+        dir_name = os.path.join(dir_name, "level" + str(i))
+        os.makedirs(dir_name, exist_ok=True)
+        file_name = os.path.join(dir_name, "file")
+        write_random_file(file_name, DEEP_FILE_SIZE, rng)
+        file_names.append(file_name)
+
+    return sorted(file_names)
+
+def mirror_dirs(source_dir, dest_dir):
+    """Creates the source tree's directories under the destination, since pysync copies files but not directories."""
+    for root, _, _ in os.walk(source_dir):
+        os.makedirs(os.path.join(dest_dir, os.path.relpath(root, source_dir)), exist_ok=True)
+
+def modify_tree(file_names, seed, fraction):
+    """Overwrites a small block in a reproducible selection of files, without changing their sizes."""
+    rng = random.Random(seed)
+    num_to_change = max(1, int(len(file_names) * fraction))
+    for file_name in rng.sample(file_names, num_to_change):
+        size = os.path.getsize(file_name)
+        offset = rng.randint(0, max(0, size - CHANGE_SIZE))
+        with open(file_name, 'r+b') as out_file:
+            out_file.seek(offset, 0)
+            out_file.write(rng.randbytes(min(CHANGE_SIZE, size)))
+    return num_to_change
+
+def read_proc_io():
+    """Returns this process's I/O counters (read/write syscall counts and bytes), or an empty dictionary if they aren't available."""
+    counters = {}
+    try:
+        with open("/proc/self/io", 'rt') as io_file:
+            for line in io_file:
+                key, value = line.split(":")
+                counters[key.strip()] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters
+
+def run_scenario(name, source_dir, dest_dir, args, hash_cache, manifest):
+    """Runs one pysync pass and returns its measurements."""
+    error_counter = ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    pysync.g_stats = pysync.SyncStats()
+    io_before = read_proc_io()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pysync.compare_dir(source_dir, dest_dir, True, True, False, False, args.no_hash, hash_cache, args.jobs, args.compare, args.strict, None, manifest)
+        if manifest is not None:
+            manifest.save()
+        if hash_cache is not None:
+            hash_cache.flush()
+    wall_seconds = time.perf_counter() - start_time
+    io_after = read_proc_io()
+    pysync.g_stats.finish()
+    logging.getLogger().removeHandler(error_counter)
+
+    result = {
+        "scenario": name,
+        "wall_seconds": wall_seconds,
+        "errors": error_counter.count,
+        "io": { key: io_after[key] - io_before.get(key, 0) for key in io_after },
+        "pysync": pysync.g_stats.report()
+    }
+    pysync.g_stats = None
+    return result
+
+def git_revision():
+    """Returns the current commit of the repo containing pysync, if there is one, so results can be matched to commits."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(pysync.__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(work_dir, args):
+    """Generates the tree and runs every scenario against it."""
+    source_dir = os.path.join(work_dir, "src")
+    dest_dir = os.path.join(work_dir, "dst")
+    print("Generating the source tree in " + source_dir + "...")
+    file_names = generate_tree(source_dir, args.seed, args.scale)
+    mirror_dirs(source_dir, dest_dir)
+
+    hash_cache = None
+    if args.hash_cache:
+        hash_cache = pysync.HashCache(os.path.join(work_dir, "hash_cache.db"))
+    manifest = None
+    if args.manifest:
+        manifest = pysync.Manifest(dest_dir)
+
+    results = []
+    try:
+        for i in range(0, args.repeat):
+            print("Running scenarios (pass " + str(i + 1) + " of " + str(args.repeat) + ")...")
+            if i > 0:
+                shutil.rmtree(dest_dir)
+                mirror_dirs(source_dir, dest_dir)
+                if manifest is not None:
+                    manifest = pysync.Manifest(dest_dir)
+            results.append(run_scenario(SCENARIO_FIRST_SYNC, source_dir, dest_dir, args, hash_cache, manifest))
+            results.append(run_scenario(SCENARIO_NO_OP_RESYNC, source_dir, dest_dir, args, hash_cache, manifest))
+            modify_tree(file_names, args.seed + i + 1, CHANGE_FRACTION)
+            results.append(run_scenario(SCENARIO_CHANGED_RESYNC, source_dir, dest_dir, args, hash_cache, manifest))
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": { "seed": args.seed, "scale": args.scale, "jobs": args.jobs, "compare": args.compare, "strict": args.strict, "no_hash": args.no_hash, "hash_algo": args.hash_algo, "hash_cache": args.hash_cache, "manifest": args.manifest },
+        "num_files": len(file_names),
+        "results": results
+    }
+
+def compare_to_baseline(report, baseline):
+    """Prints the change in wall time for each scenario relative to an earlier report."""
+    baseline_times = {}
+    for result in baseline["results"]:
+        baseline_times.setdefault(result["scenario"], []).append(result["wall_seconds"])
+    current_times = {}
+    for result in report["results"]:
+        current_times.setdefault(result["scenario"], []).append(result["wall_seconds"])
+    for scenario, times in current_times.items():
+        if scenario not in baseline_times:
+            continue
+        current = min(times)
+        previous = min(baseline_times[scenario])
+        change = 0.0
+        if previous > 0:
+            change = (current - previous) / previous * 100.0
+        print("{:<20} {:>10.3f} s {:>10.3f} s {:>+8.1f}%".format(scenario, previous, current, change))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work-dir", type=str, action="store", default=None, help="Directory in which to generate the trees (default: a temporary directory)", required=False)
+    parser.add_argument("--keep", action="store_true", default=False, help="Don't delete the generated trees afterwards", required=False)
+    parser.add_argument("--seed", type=int, action="store", default=1, help="Random seed used to generate the trees", required=False)
+    parser.add_argument("--scale", type=float, action="store", default=1.0, help="Multiplier for the number of tiny files and the size of the huge files", required=False)
+    parser.add_argument("--repeat", type=int, action="store", default=1, help="Number of times to run the scenarios", required=False)
+    parser.add_argument("--jobs", type=int, action="store", default=1, help="Passed to pysync", required=False)
+    parser.add_argument("--compare", type=str, action="store", default=pysync.COMPARE_HASH, choices=pysync.COMPARE_MODES, help="Passed to pysync", required=False)
+    parser.add_argument("--strict", action="store_true", default=False, help="Passed to pysync", required=False)
+    parser.add_argument("--no-hash", action="store_true", default=False, help="Passed to pysync", required=False)
+    parser.add_argument("--hash-algo", type=str, action="store", default=pysync.hashing.DEFAULT_HASH_ALGORITHM, choices=pysync.hashing.available_algorithms(), help="Passed to pysync", required=False)
+    parser.add_argument("--hash-cache", action="store_true", default=False, help="Use a hash cache in the work directory", required=False)
+    parser.add_argument("--manifest", action="store_true", default=False, help="Use a destination manifest", required=False)
+    parser.add_argument("--output", type=str, action="store", default=None, help="File to write the JSON results to (default: stdout)", required=False)
+    parser.add_argument("--baseline", type=str, action="store", default=None, help="JSON results from an earlier run to compare against", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    pysync.g_hash_algorithm = args.hash_algo
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="pysync_benchmark_")
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        report = run_benchmark(work_dir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report_str = json.dumps(report, indent=4)
+    if args.output is None:
+        print(report_str)
+    else:
+        with open(args.output, 'wt') as out_file:
+            out_file.write(report_str + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'rt') as baseline_file:
+            compare_to_baseline(report, json.load(baseline_file))
+
+if __name__ == "__main__":
+    main()